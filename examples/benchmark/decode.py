@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# compares the compiled decode plans with the descriptor walker
+import sys
+import timeit
+
+import pymachinetalk.common as common
+from pymachinetalk.common import get_decode_plan, recurse_message
+import traffic
+
+
+def run(name, message, number):
+    obj = get_decode_plan(message.DESCRIPTOR).new_object()
+    recurse_message(message, obj)  # warm up and grow arrays
+
+    results = []
+    for use_decode_plans in (False, True):
+        common.use_decode_plans = use_decode_plans
+        duration = timeit.timeit(lambda: recurse_message(message, obj), number=number)
+        results.append(duration / number * 1e6)
+
+    print('%-24s walker %8.2f us  plan %8.2f us  speedup %.2fx'
+          % (name, results[0], results[1], results[0] / results[1]))
+
+
+def main():
+    number = 1000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+
+    run('motion full', traffic.motion_full_update().emc_status_motion, number)
+    run('motion incremental', traffic.motion_incremental_update().emc_status_motion, number)
+    run('config full', traffic.config_full_update().emc_status_config, number)
+    run('config incremental', traffic.config_incremental_update().emc_status_config, number)
+
+
+if __name__ == "__main__":
+    main()
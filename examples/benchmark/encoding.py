@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# checks the hand encoded command templates and pin set messages against
+# the protobuf encoder, every message is parsed back and must serialize
+# to the same bytes as the message built with protobuf, values protobuf
+# rejects must raise ValueError, the raw column counts the messages that
+# were byte identical before parsing
+# usage: encoding.py
+import sys
+
+from machinetalk.protobuf.message_pb2 import Container
+from machinetalk.protobuf.types_pb2 import *
+from machinetalk.protobuf.status_pb2 import *
+from pymachinetalk.application import command_template, TELEOP_VECTOR_PATHS
+from pymachinetalk.halremote import set_message, encode_pin, PIN_VALUE_FIELDS
+
+INT_VALUES = (0, 1, 127, 128, 300, 2 ** 31 - 1, -1, -2 ** 31)
+FLOAT_VALUES = (0.0, 1.5, -2.25, 1e-300, 1e300, float('inf'))
+STRING_VALUES = (u'', u'execute', u'G0 X1 (\xe4\xf6\xfc)')
+BOOL_VALUES = (True, False)
+
+# message type, paths and the candidate values of each path
+COMMANDS = [
+    (MT_EMC_TASK_ABORT, ('interp_name', ), (STRING_VALUES, )),
+    (MT_EMC_TASK_PLAN_RUN, ('emc_command_params.line_number', 'interp_name'),
+     (INT_VALUES, STRING_VALUES)),
+    (MT_EMC_TASK_SET_MODE, ('emc_command_params.task_mode', 'interp_name'),
+     ((EMC_TASK_MODE_MANUAL, EMC_TASK_MODE_AUTO, EMC_TASK_MODE_MDI), STRING_VALUES)),
+    (MT_EMC_TASK_SET_STATE, ('emc_command_params.task_state', 'interp_name'),
+     ((EMC_TASK_STATE_ESTOP, EMC_TASK_STATE_ON), STRING_VALUES)),
+    (MT_EMC_TASK_PLAN_OPEN, ('emc_command_params.path', 'interp_name'),
+     ((u'/tmp/a.ngc', u'/home/m\xfcller/b.ngc'), STRING_VALUES)),
+    (MT_EMC_TASK_PLAN_EXECUTE, ('emc_command_params.command', 'interp_name'),
+     (STRING_VALUES, STRING_VALUES)),
+    (MT_EMC_TRAJ_SET_SCALE, ('emc_command_params.scale', ), (FLOAT_VALUES, )),
+    (MT_EMC_AXIS_JOG, ('emc_command_params.index', 'emc_command_params.velocity'),
+     (INT_VALUES, FLOAT_VALUES)),
+    (MT_EMC_AXIS_INCR_JOG, ('emc_command_params.index', 'emc_command_params.velocity',
+                            'emc_command_params.distance'),
+     (INT_VALUES, FLOAT_VALUES, FLOAT_VALUES)),
+    (MT_EMC_MOTION_SET_DOUT, ('emc_command_params.index', 'emc_command_params.enable'),
+     (INT_VALUES, BOOL_VALUES)),
+    (MT_EMC_MOTION_SET_AOUT, ('emc_command_params.index', 'emc_command_params.value'),
+     (INT_VALUES, FLOAT_VALUES)),
+    (MT_EMC_TRAJ_SET_TELEOP_VECTOR, TELEOP_VECTOR_PATHS, ((b'', ), ) + (FLOAT_VALUES, ) * 6),
+    (MT_SHUTDOWN, (), ()),
+]
+
+# type and candidate values of the pins in a set message
+PINS = [
+    (HAL_FLOAT, FLOAT_VALUES),
+    (HAL_BIT, BOOL_VALUES),
+    (HAL_S32, INT_VALUES),
+    (HAL_U32, (0, 1, 128, 2 ** 32 - 1)),
+]
+
+
+def rotate(candidates, i):
+    return candidates[i % len(candidates)]
+
+
+def set_path(message, path, value):
+    elements = path.split('.')
+    for name in elements[:-1]:
+        message = getattr(message, name)
+    field = message.DESCRIPTOR.fields_by_name[elements[-1]]
+    if field.message_type is not None:  # encoded messages are merged
+        getattr(message, elements[-1]).MergeFromString(value)
+    else:
+        setattr(message, elements[-1], value)
+
+
+# expected is None for values protobuf rejects
+def check(name, template, values, expected, results):
+    count, raw, rejected, failures = results.get(name, (0, 0, 0, []))
+    try:
+        data = bytes(template.encode(values))
+    except ValueError:
+        data = None
+    if expected is None:
+        rejected += 1
+        if data is not None:
+            failures.append((data, None))
+    else:
+        reference = expected.SerializeToString()
+        if data is None or Container.FromString(data).SerializeToString() != reference:
+            failures.append((data, reference))
+        raw += data == reference
+    results[name] = (count + 1, raw, rejected, failures)
+
+
+def check_commands(results):
+    ticket = 0
+    for msg_type, paths, candidates in COMMANDS:
+        template = command_template(msg_type, *paths)
+        name = Container.DESCRIPTOR.fields_by_name['type'].enum_type.values_by_number[msg_type].name
+        variants = max([len(c) for c in candidates] + [1])
+        for i in range(variants):
+            values = tuple(rotate(c, i + j) for j, c in enumerate(candidates))
+            ticket += 1
+            expected = Container(type=msg_type, ticket=ticket)
+            try:
+                for path, value in zip(paths, values):
+                    set_path(expected, path, value)
+            except ValueError:
+                expected = None  # the template must reject it as well
+            check(name, template, values + (ticket, ), expected, results)
+
+
+class PinSet():
+    """Encodes a set message like RemoteComponent.send_pins."""
+    def __init__(self, headers, pintype):
+        self.headers = headers
+        self.pintype = pintype
+
+    def encode(self, pins):
+        data = bytearray(set_message)
+        for handle, value in pins:
+            data += encode_pin(self.headers, self.pintype, handle, value)
+        return data
+
+
+def check_pins(results):
+    headers = {}
+    for count in (1, 2, 5):
+        for pintype, candidates in PINS:
+            pins = [(1000 + i * 70000, rotate(candidates, i + count)) for i in range(count)]
+            expected = Container(type=MT_HALRCOMP_SET)
+            for handle, value in pins:
+                pin = expected.pin.add(handle=handle, type=pintype)
+                setattr(pin, PIN_VALUE_FIELDS[pintype], value)
+            check('MT_HALRCOMP_SET', PinSet(headers, pintype), pins, expected, results)
+
+
+def main():
+    results = {}
+    check_commands(results)
+    check_pins(results)
+
+    print('%-32s %8s %8s %8s %8s' % ('message', 'checked', 'raw', 'rejected', 'failed'))
+    failed = 0
+    for name in sorted(results):
+        count, raw, rejected, failures = results[name]
+        print('%-32s %8i %8i %8i %8i' % (name, count, raw, rejected, len(failures)))
+        for data, reference in failures[:3]:
+            print('  got      %r' % bytes(data))
+            print('  expected %r' % reference)
+        failed += len(failures)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
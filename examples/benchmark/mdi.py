@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# streams MDI lines to a simulated command service with a network delay
+# and compares the window sizes, window 1 waits for every line
+# usage: mdi.py [lines] [delay ms] [execution ms]
+import sys
+import time
+import heapq
+import threading
+
+import zmq
+
+from machinetalk.protobuf.message_pb2 import Container
+from machinetalk.protobuf.types_pb2 import *
+from pymachinetalk.application import ApplicationCommand, MdiStream
+
+
+class CommandService():
+    """Answers pings and executes MDI lines one after another, every
+    reply is delayed by the network delay."""
+    def __init__(self, delay, execution):
+        self.delay = delay
+        self.execution = execution
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.uri = 'tcp://127.0.0.1:%i' % port
+        self.shutdown_event = threading.Event()
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        rx = Container()
+        tx = Container()
+        replies = []  # (send time, sequence, identity, type, ticket)
+        sequence = 0
+        busy_until = 0.0
+        poll = zmq.Poller()
+        poll.register(self.socket, zmq.POLLIN)
+        while not self.shutdown_event.is_set():
+            timeout = 100
+            if replies:
+                timeout = max(0, int((replies[0][0] - time.time()) * 1000))
+            if poll.poll(timeout):
+                identity, msg = self.socket.recv_multipart()
+                rx.ParseFromString(msg)
+                now = time.time()
+                if rx.type == MT_PING:
+                    tx.type = MT_PING_ACKNOWLEDGE
+                    self.socket.send_multipart([identity, tx.SerializeToString()])
+                    tx.Clear()
+                    continue
+                arrival = now + self.delay
+                busy_until = max(busy_until, arrival) + self.execution
+                for send_time, msg_type in ((arrival + self.delay, MT_EMCCMD_EXECUTED),
+                                            (busy_until + self.delay, MT_EMCCMD_COMPLETED)):
+                    heapq.heappush(replies, (send_time, sequence, identity, msg_type, rx.ticket))
+                    sequence += 1
+            now = time.time()
+            while replies and replies[0][0] <= now:
+                _, _, identity, msg_type, ticket = heapq.heappop(replies)
+                tx.type = msg_type
+                tx.reply_ticket = ticket
+                self.socket.send_multipart([identity, tx.SerializeToString()])
+                tx.Clear()
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.thread.join()
+        self.socket.close()
+
+
+def main():
+    lines = 200
+    delay = 0.002
+    execution = 0.0002
+    if len(sys.argv) > 1:
+        lines = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        delay = float(sys.argv[2]) / 1000.0
+    if len(sys.argv) > 3:
+        execution = float(sys.argv[3]) / 1000.0
+
+    service = CommandService(delay, execution)
+    command = ApplicationCommand()
+    command.max_inflight = 0  # the stream window bounds the commands in flight
+    command.command_uri = service.uri
+    command.ready()
+    command.wait_connected(5.0)
+
+    print('%i lines, %.1f ms delay, %.1f ms execution' % (lines, delay * 1000, execution * 1000))
+    print('%8s %10s %12s %12s %12s %12s' % ('window', 'release', 'lines/s', 'p50 [ms]',
+                                            'p90 [ms]', 'max [ms]'))
+    for window, release in ((1, 'completed'), (4, 'completed'), (16, 'completed'),
+                            (64, 'completed'), (16, 'executed')):
+        stream = MdiStream(command, window=window, release=release)
+        program = ('G0 X%i Y%i' % (i % 100, i % 50) for i in range(lines))
+        if not stream.run(program):
+            print('stream failed at line %s: %s' % (stream.error_line, stream.error))
+        stats = stream.statistics()
+        print('%8i %10s %12.0f %12.2f %12.2f %12.2f'
+              % (window, release, stats['lines_per_second'], stats['latency_p50'] * 1000,
+                 stats['latency_p90'] * 1000, stats['latency_max'] * 1000))
+
+    command.stop()
+    service.stop()
+
+
+if __name__ == "__main__":
+    main()
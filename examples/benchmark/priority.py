@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# measures how long an abort takes to reach a busy command service while
+# another thread floods the normal lane with MDI commands, and checks that
+# no command older than the abort arrives after it, the abort only skips
+# the commands not yet handed to ZeroMQ, so bounding the commands in
+# flight is what keeps it fast
+# usage: priority.py [rounds] [flood commands] [execution ms]
+import sys
+import time
+import threading
+
+import zmq
+
+from machinetalk.protobuf.message_pb2 import Container
+from machinetalk.protobuf.types_pb2 import *
+from pymachinetalk.common import RemoteError
+from pymachinetalk.application import ApplicationCommand, MT_EMC_TASK_ABORT
+
+
+class CommandService():
+    """Acknowledges every command after the execution time, records
+    when an abort arrived and counts older commands arriving after it."""
+    def __init__(self, execution):
+        self.execution = execution
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.SNDHWM, 0)
+        self.socket.setsockopt(zmq.RCVHWM, 0)
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.uri = 'tcp://127.0.0.1:%i' % port
+        self.abort_event = threading.Event()
+        self.abort_time = 0.0
+        self.abort_ticket = None
+        self.late = 0  # commands with a lower ticket received after the abort
+        self.received = 0
+        self.shutdown_event = threading.Event()
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def worker(self):
+        rx = Container()
+        tx = Container()
+        poll = zmq.Poller()
+        poll.register(self.socket, zmq.POLLIN)
+        while not self.shutdown_event.is_set():
+            if not poll.poll(100):
+                continue
+            identity, msg = self.socket.recv_multipart()
+            rx.ParseFromString(msg)
+            if rx.type == MT_PING:
+                tx.type = MT_PING_ACKNOWLEDGE
+            else:
+                self.received += 1
+                if rx.type == MT_EMC_TASK_ABORT:
+                    self.abort_time = time.time()
+                    self.abort_ticket = rx.ticket
+                    self.abort_event.set()
+                else:
+                    if self.abort_ticket is not None and rx.ticket < self.abort_ticket:
+                        self.late += 1
+                    time.sleep(self.execution)
+                tx.type = MT_EMCCMD_COMPLETED
+                tx.reply_ticket = rx.ticket
+            self.socket.send_multipart([identity, tx.SerializeToString()])
+            tx.Clear()
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.thread.join()
+        self.socket.close()
+
+
+def flood(command, count, started):
+    for i in range(count):
+        try:
+            command.execute_mdi('G0 X%i' % (i % 100))
+        except RemoteError:
+            pass  # waited for a slot and was dropped by the abort
+        if i == count // 4:
+            started.set()
+    started.set()
+
+
+def shared_abort(command):
+    # abort as it was sent before the priority lane existed
+    with command.tx_lock:
+        command.tx.interp_name = 'execute'
+        return command.send_command_msg(MT_EMC_TASK_ABORT)
+
+
+def measure(command, service, count, abort):
+    started = threading.Event()
+    thread = threading.Thread(target=flood, args=(command, count, started))
+    thread.start()
+    started.wait()
+    service.abort_event.clear()
+    service.abort_ticket = None
+    service.late = 0
+    start_time = time.time()
+    abort()
+    call_time = time.time() - start_time
+    service.abort_event.wait(10.0)
+    arrival_time = service.abort_time - start_time
+    thread.join()
+    command.wait_tickets(list(command.inflight), 10.0)
+    return call_time, arrival_time, service.late
+
+
+def main():
+    rounds = 5
+    count = 2000
+    execution = 0.0002
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        execution = float(sys.argv[3]) / 1000.0
+
+    service = CommandService(execution)
+    command = ApplicationCommand()
+    command.command_socket.setsockopt(zmq.SNDHWM, 0)
+    command.command_uri = service.uri
+    command.ready()
+    command.wait_connected(5.0)
+
+    print('abort while %i MDI commands are sent, %.1f ms execution, %i rounds'
+          % (count, execution * 1000, rounds))
+    print('%14s %14s %14s %14s %14s %8s' % ('lane', 'call p50 [ms]', 'call max [ms]',
+                                            'recv p50 [ms]', 'recv max [ms]', 'late'))
+    for name, abort, max_inflight in (('shared', lambda: shared_abort(command), 0),
+                                      ('unbounded', command.abort, 0),
+                                      ('priority', command.abort, 32),  # the default
+                                      ('priority/16', command.abort, 16)):
+        command.max_inflight = max_inflight
+        calls = []
+        arrivals = []
+        late = 0
+        for _ in range(rounds):
+            call_time, arrival_time, round_late = measure(command, service, count, abort)
+            calls.append(call_time * 1000)
+            arrivals.append(arrival_time * 1000)
+            late += round_late
+        calls.sort()
+        arrivals.sort()
+        print('%14s %14.3f %14.3f %14.3f %14.3f %8i'
+              % (name, calls[len(calls) // 2], calls[-1],
+                 arrivals[len(arrivals) // 2], arrivals[-1], late))
+        assert late == 0, '%i older commands arrived after the abort' % late
+
+    command.stop()
+    service.stop()
+
+
+if __name__ == "__main__":
+    main()
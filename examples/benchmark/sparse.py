@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# shows the cost of an incremental update against the number of changed fields
+import sys
+import timeit
+
+import pymachinetalk.common as common
+from pymachinetalk.common import get_decode_plan, recurse_message
+from machinetalk.protobuf.message_pb2 import Container
+
+
+def scalar_fields(descriptor):
+    fields = []
+    for field in descriptor.fields:
+        if field.label != field.LABEL_REPEATED and field.type != field.TYPE_MESSAGE:
+            fields.append(field)
+    return fields
+
+
+def incremental_update(fields, count):
+    rx = Container()
+    motion = rx.emc_status_motion
+    for field in fields[:count]:
+        if field.type == field.TYPE_BOOL:
+            value = True
+        elif field.type in (field.TYPE_DOUBLE, field.TYPE_FLOAT):
+            value = 1.5
+        elif field.type == field.TYPE_ENUM:
+            value = field.enum_type.values[-1].number
+        elif field.type == field.TYPE_STRING:
+            value = 'changed'
+        else:
+            value = 1
+        setattr(motion, field.name, value)
+    return motion
+
+
+def main():
+    number = 2000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+
+    fields = scalar_fields(Container().emc_status_motion.DESCRIPTOR)
+    obj = get_decode_plan(Container().emc_status_motion.DESCRIPTOR).new_object()
+
+    print('EmcStatusMotion, %i scalar fields' % len(fields))
+    print('%8s %14s %14s' % ('changed', 'walker [us]', 'plan [us]'))
+    count = 0
+    while count <= len(fields):
+        message = incremental_update(fields, count)
+        results = []
+        for use_decode_plans in (False, True):
+            common.use_decode_plans = use_decode_plans
+            duration = timeit.timeit(lambda: recurse_message(message, obj), number=number)
+            results.append(duration / number * 1e6)
+        print('%8i %14.2f %14.2f' % (count, results[0], results[1]))
+        count = count * 2 if count else 1
+    common.use_decode_plans = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# runs the decode and dispatch hot paths against synthetic traffic
+# usage: suite.py [iterations] [scenario filter]
+# the alloc column shows the peak KiB and the retained blocks per message
+# with tracemalloc, on Python 2 the growth of the maximum resident set in
+# KiB and the retained garbage collected objects per message
+import gc
+import sys
+import time
+import resource
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2 falls back to the gc and rusage counters
+
+from pymachinetalk.common import recurse_message
+from pymachinetalk.application import ApplicationStatus, ApplicationCommand
+from pymachinetalk.application import ping_template
+from pymachinetalk.halremote import RemoteComponent, HAL_FLOAT, HAL_IN, HAL_OUT
+import traffic
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def status_scenario(topic, *messages):
+    status = ApplicationStatus()
+    status.subscriptions.add(topic)
+    frames = [(topic, message.SerializeToString()) for message in messages]
+    status.status_socket = traffic.ReplaySocket(frames)
+    status.process_status()  # apply the first message once
+    return status.process_status
+
+
+def recurse_scenario():
+    status = ApplicationStatus()
+    motion = traffic.motion_incremental_update().emc_status_motion
+    data = status.motion_data
+    return lambda: recurse_message(motion, data)
+
+
+def halrcomp_scenario(pins, changed, compact=False):
+    comp = RemoteComponent('bench', compact=compact)
+    for i in range(pins):
+        comp.newpin('pin%i' % i, HAL_FLOAT, HAL_IN)
+    full_update = traffic.halrcomp_full_update('bench', pins).SerializeToString()
+    frames = [('bench', full_update)]
+    if changed > 0:
+        frames = [('bench', traffic.halrcomp_incremental_update(changed, value=1.0).SerializeToString()),
+                  ('bench', traffic.halrcomp_incremental_update(changed, value=2.0).SerializeToString())]
+    comp.halrcomp_socket = traffic.ReplaySocket([('bench', full_update)])
+    comp.process_halrcomp()  # bind the pin handles
+    comp.halrcomp_socket = traffic.ReplaySocket(frames)
+    return comp.process_halrcomp
+
+
+def bind_scenario(pins):
+    comp = RemoteComponent('bench')
+    for i in range(pins):
+        comp.newpin('pin%i' % i, HAL_FLOAT, HAL_IN)
+    comp.halrcmd_socket = traffic.ReplaySocket()
+    return comp.bind
+
+
+def set_scenario(pins):
+    comp = RemoteComponent('bench')
+    changed = [comp.newpin('pin%i' % i, HAL_FLOAT, HAL_OUT) for i in range(pins)]
+    for i, pin in enumerate(changed):
+        pin.handle = 1000 + i
+    comp.halrcmd_socket = traffic.ReplaySocket()
+    return lambda: comp.send_pin_changes(changed)
+
+
+def command_scenario():
+    command = ApplicationCommand()
+    command.command_socket = traffic.ReplaySocket()
+    command.connected = True
+
+    def step():
+        command.execute_mdi('G0 X10 Y20 Z30')
+        command.inflight.clear()  # no replies arrive
+    return step
+
+
+def ping_scenario():
+    command = ApplicationCommand()
+    command.command_socket = traffic.ReplaySocket()
+    return lambda: command.send_template(ping_template)
+
+
+SCENARIOS = [
+    ('status motion full', lambda: status_scenario('motion', traffic.motion_full_update())),
+    ('status motion incremental', lambda: status_scenario('motion', traffic.motion_incremental_update())),
+    ('status config sparse', lambda: status_scenario('config', traffic.config_full_update(),
+                                                     traffic.config_incremental_update())),
+    ('status io 1000 tools', lambda: status_scenario('io', traffic.io_full_update(1000))),
+    ('recurse_message motion', recurse_scenario),
+    ('halrcomp full 2000 pins', lambda: halrcomp_scenario(2000, 0)),
+    ('halrcomp incremental 40 pins', lambda: halrcomp_scenario(2000, 40)),
+    ('halrcomp full 2000 compact', lambda: halrcomp_scenario(2000, 0, compact=True)),
+    ('halrcomp incr 40 compact', lambda: halrcomp_scenario(2000, 40, compact=True)),
+    ('halrcomp bind 2000 pins', lambda: bind_scenario(2000)),
+    ('halrcmd set 40 pins', lambda: set_scenario(40)),
+    ('command execute_mdi', command_scenario),
+    ('command ping', ping_scenario),
+]
+
+
+def percentile(samples, fraction):
+    index = min(len(samples) - 1, int(len(samples) * fraction))
+    return samples[index]
+
+
+def measure(step, iterations):
+    latencies = []
+    start = timer()
+    for _ in range(iterations):
+        t0 = timer()
+        step()
+        latencies.append(timer() - t0)
+    duration = timer() - start
+    latencies.sort()
+    return iterations / duration, latencies
+
+
+def measure_allocations(step, iterations):
+    if tracemalloc is None:
+        gc.collect()
+        objects = len(gc.get_objects())
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on Linux
+        for _ in range(iterations):
+            step()
+        gc.collect()
+        retained = len(gc.get_objects()) - objects
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss
+        return growth, retained / float(iterations)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(iterations):
+        step()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return peak / 1024.0, blocks / float(iterations)
+
+
+def main():
+    iterations = 1000
+    name_filter = ''
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        name_filter = sys.argv[2]
+
+    results = []
+    for name, setup in SCENARIOS:
+        if name_filter not in name:
+            continue
+        step = setup()
+        allocations = measure_allocations(step, min(iterations, 200))  # first, for the peak
+        rate, latencies = measure(step, iterations)
+        results.append((name, rate, latencies, allocations))
+
+    print('%-30s %12s %10s %10s %10s %10s %12s' % ('scenario', 'msg/s', 'p50 [us]', 'p90 [us]',
+                                                 'p99 [us]', 'max [us]', 'alloc'))
+    for name, rate, latencies, allocations in results:
+        if allocations is None:
+            alloc = 'n/a'
+        else:
+            alloc = '%.0fK/%+.1f' % allocations  # peak KiB / retained objects per message
+        print('%-30s %12.0f %10.1f %10.1f %10.1f %10.1f %12s'
+              % (name, rate, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.9) * 1e6,
+                 percentile(latencies, 0.99) * 1e6, latencies[-1] * 1e6, alloc))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# shows the receive cost of halrcomp traffic for many components on one
+# haltalk, the subscriber only owns one of the topics
+# usage: topics.py [number] [pins per component]
+import sys
+import timeit
+
+import zmq
+
+from machinetalk.protobuf.message_pb2 import Container
+from pymachinetalk.halremote import RemoteComponent, HAL_FLOAT, HAL_IN
+import traffic
+
+
+def component_frames(components, pins):
+    frames = []
+    for i in range(components):
+        name = 'comp%i' % i
+        update = traffic.halrcomp_incremental_update(pins, base_handle=1000 * (i + 1))
+        frames.append((name, update.SerializeToString()))
+    return frames
+
+
+def parse_then_check(comp, socket):
+    # receive path before dispatching on the topic
+    (topic, msg) = socket.recv_multipart()
+    comp.rx.ParseFromString(msg)
+    if topic != comp.name:
+        return
+    comp.halrcomp_message(topic, comp.rx)
+
+
+def run_topics(components, pins, number):
+    frames = component_frames(components, pins)
+    comp = RemoteComponent('comp0')
+    for i in range(pins):
+        comp.newpin('pin%i' % i, HAL_FLOAT, HAL_IN)
+    full_update = traffic.halrcomp_full_update('comp0', pins).SerializeToString()
+    comp.halrcomp_socket = traffic.ReplaySocket([('comp0', full_update)])
+    comp.process_halrcomp()  # bind the pin handles
+
+    socket = traffic.ReplaySocket(frames)
+    comp.halrcomp_socket = traffic.ReplaySocket(frames)
+    old = timeit.timeit(lambda: parse_then_check(comp, socket), number=number)
+    new = timeit.timeit(comp.process_halrcomp, number=number)
+    print('%6i components %12.2f us %12.2f us %8.2fx'
+          % (components, old / number * 1e6, new / number * 1e6, old / new))
+
+
+def run_copy(pins, number):
+    context = zmq.Context()
+    pub = context.socket(zmq.PUB)
+    pub.bind('inproc://topics')
+    sub = context.socket(zmq.SUB)
+    sub.connect('inproc://topics')
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    sub.setsockopt(zmq.RCVHWM, 0)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    message = traffic.halrcomp_full_update('comp0', pins).SerializeToString()
+    rx = Container()
+
+    def receive(copy, parse):
+        pub.send_multipart([b'comp0', message], copy=False)
+        (topic, msg) = sub.recv_multipart(copy=copy)
+        if not parse:
+            return  # foreign topic
+        if copy:
+            rx.ParseFromString(msg)
+        else:
+            rx.ParseFromString(msg.buffer)
+
+    receive(True, False)  # wait for the subscription to be connected
+    results = []
+    for parse in (False, True):
+        for copy in (True, False):
+            duration = timeit.timeit(lambda: receive(copy, parse), number=number)
+            results.append(duration / number * 1e6)
+    print('%6i pins %8i bytes %10.2f us %10.2f us %10.2f us %10.2f us'
+          % ((pins, len(message)) + tuple(results)))
+    sub.close()
+    pub.close()
+    context.term()
+
+
+def main():
+    number = 2000
+    pins = 40
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        pins = int(sys.argv[2])
+
+    print('incremental updates with %i pins, one owned topic' % pins)
+    print('%17s %15s %15s %9s' % ('', 'parse first', 'topic first', 'speedup'))
+    for components in (1, 2, 5, 20):
+        run_topics(components, pins, number)
+
+    print('')
+    print('full update send and receive, copying and zero-copy frames')
+    print('%24s %13s %13s %13s %13s' % ('', 'skip copy', 'skip 0-copy',
+                                        'parse copy', 'parse 0-copy'))
+    for count in (40, 2000, 20000):
+        run_copy(count, number // 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# synthetic Machinetalk traffic for the benchmarks
+import itertools
+
+import zmq
+
+from machinetalk.protobuf.message_pb2 import Container
+from machinetalk.protobuf.types_pb2 import *
+
+
+class ReplaySocket():
+    """Stands in for a ZeroMQ socket, replays the given frames in a loop
+    and counts the sent messages."""
+    def __init__(self, frames=None):
+        frames = frames or [b'']
+        self.frames = itertools.cycle(frames)
+        self.zmq_frames = itertools.cycle([zero_copy_frames(f) for f in frames])
+        self.sent = 0
+        self.sent_bytes = 0
+
+    def recv(self, flags=0, copy=True):
+        if not copy:
+            return next(self.zmq_frames)
+        return next(self.frames)
+
+    def recv_multipart(self, flags=0, copy=True):
+        if not copy:
+            return next(self.zmq_frames)
+        return next(self.frames)
+
+    def send(self, data, flags=0, copy=True):
+        self.sent += 1
+        self.sent_bytes += len(data)
+
+    def send_multipart(self, frames, flags=0, copy=True):
+        self.sent += 1
+
+    def setsockopt(self, option, value):
+        pass
+
+
+def zero_copy_frames(frames):
+    if isinstance(frames, (list, tuple)):
+        return [zmq.Frame(frame) for frame in frames]
+    return zmq.Frame(frames)
+
+
+def fill_position(position, offset):
+    for i, axis in enumerate('xyzabcuvw'):
+        setattr(position, axis, offset + i * 0.1)
+
+
+def motion_full_update():
+    tx = Container()
+    tx.type = MT_EMCSTAT_FULL_UPDATE
+    motion = tx.emc_status_motion
+    motion.active_queue = 1
+    motion.current_line = 100
+    motion.current_vel = 12.5
+    motion.distance_to_go = 3.2
+    motion.enabled = True
+    motion.feedrate = 1.0
+    motion.spindle_speed = 1000.0
+    motion.spindlerate = 1.0
+    motion.state = 1
+    for name in ('actual_position', 'position', 'dtg', 'g5x_offset',
+                 'g92_offset', 'joint_actual_position', 'joint_position',
+                 'probed_position'):
+        fill_position(getattr(motion, name), 1.0)
+    for i in range(9):
+        axis = motion.axis.add()
+        axis.index = i
+        axis.enabled = True
+        axis.homed = True
+        axis.input = i * 1.0
+        axis.output = i * 1.0
+        axis.velocity = 0.0
+    for i in range(64):
+        din = motion.din.add()
+        din.index = i
+        din.value = bool(i % 2)
+        ain = motion.ain.add()
+        ain.index = i
+        ain.value = i * 0.5
+    return tx
+
+
+def motion_incremental_update():
+    tx = Container()
+    tx.type = MT_EMCSTAT_INCREMENTAL_UPDATE
+    motion = tx.emc_status_motion
+    fill_position(motion.position, 2.0)
+    fill_position(motion.actual_position, 2.0)
+    motion.current_vel = 13.0
+    motion.distance_to_go = 3.0
+    return tx
+
+
+def config_full_update():
+    tx = Container()
+    tx.type = MT_EMCSTAT_FULL_UPDATE
+    config = tx.emc_status_config
+    config.default_acceleration = 100.0
+    config.axes = 4
+    config.axis_mask = 15
+    config.cycle_time = 0.001
+    config.max_acceleration = 200.0
+    config.max_velocity = 50.0
+    config.default_velocity = 10.0
+    config.max_feed_override = 1.2
+    config.min_feed_override = 0.0
+    config.name = 'benchmark'
+    config.remote_path = '/home/machinekit/nc_files'
+    for i in range(9):
+        axis = config.axis.add()
+        axis.index = i
+        axis.axis_type = 1
+        axis.max_position_limit = 100.0
+        axis.min_position_limit = -100.0
+        axis.max_velocity = 20.0
+        axis.max_acceleration = 200.0
+    for i, extension in enumerate(('.ngc', '.nc', '.tap')):
+        program_extension = config.program_extension.add()
+        program_extension.index = i
+        program_extension.extension = extension
+    return tx
+
+
+def config_incremental_update():
+    tx = Container()
+    tx.type = MT_EMCSTAT_INCREMENTAL_UPDATE
+    tx.emc_status_config.max_velocity = 40.0
+    return tx
+
+
+def io_full_update(tools=1000):
+    tx = Container()
+    tx.type = MT_EMCSTAT_FULL_UPDATE
+    io = tx.emc_status_io
+    io.estop = False
+    io.flood = False
+    io.tool_in_spindle = 1
+    for i in range(tools):
+        tool = io.tool_table.add()
+        tool.index = i
+        tool.id = i + 1
+        tool.diameter = 0.5 + i * 0.01
+        tool.pocket = i + 1
+        tool.comment = 'tool %i' % (i + 1)
+        fill_position(tool.offset, i * 0.001)
+    return tx
+
+
+def halrcomp_full_update(name, pins, base_handle=1000):
+    tx = Container()
+    tx.type = MT_HALRCOMP_FULL_UPDATE
+    comp = tx.comp.add()
+    comp.name = name
+    for i in range(pins):
+        pin = comp.pin.add()
+        pin.name = '%s.pin%i' % (name, i)
+        pin.handle = base_handle + i
+        pin.type = HAL_FLOAT
+        pin.halfloat = i * 0.5
+    return tx
+
+
+def halrcomp_incremental_update(changed, base_handle=1000, value=1.0):
+    tx = Container()
+    tx.type = MT_HALRCOMP_INCREMENTAL_UPDATE
+    for i in range(changed):
+        pin = tx.pin.add()
+        pin.handle = base_handle + i
+        pin.type = HAL_FLOAT
+        pin.halfloat = value + i
+    return tx
@@ -27,12 +27,14 @@ class TestClass():
         self.halrcmdReady = False
         self.halrcompReady = False
 
-        halrcomp = halremote.component('test')
+        # both components share the halrcmd and halrcomp connections
+        self.halrcomp_session = halremote.RemoteSession()
+        halrcomp = self.halrcomp_session.component('test')
         halrcomp.newpin("coolant-iocontrol", halremote.HAL_BIT, halremote.HAL_IN)
         halrcomp.newpin("coolant", halremote.HAL_BIT, halremote.HAL_OUT)
         self.halrcomp = halrcomp
 
-        halrcomp2 = halremote.RemoteComponent(name='test2')
+        halrcomp2 = self.halrcomp_session.component('test2')
         halrcomp2.newpin("coolant-iocontrol", halremote.HAL_BIT, halremote.HAL_IN)
         halrcomp2.newpin("coolant", halremote.HAL_BIT, halremote.HAL_OUT)
         self.halrcomp2 = halrcomp2
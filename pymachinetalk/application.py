@@ -1,6 +1,8 @@
 import uuid
 import platform
 import os
+import time
+import collections
 from urlparse import urlparse
 import ftplib
 
@@ -65,13 +67,42 @@ OPERATOR_ERROR = MT_EMC_OPERATOR_ERROR
 OPERATOR_TEXT = MT_EMC_OPERATOR_TEXT
 OPERATOR_DISPLAY = MT_EMC_OPERATOR_DISPLAY
 
+# the required translation is sent as an empty message
+TELEOP_VECTOR_PATHS = ('emc_command_params.pose.tran', ) + \
+    tuple('emc_command_params.pose.%s' % axis for axis in 'abcuvw')
+
+# commands the service never completes, their futures resolve once sent
+UNANSWERED_COMMANDS = frozenset([MT_SHUTDOWN])
+
+# pre-encoded commands by message type and parameter paths
+ping_template = MessageTemplate(Container(type=MT_PING))
+command_templates = {}
+
+
+# the ticket is appended to the parameters as the last field
+def command_template(msg_type, *paths):
+    template = command_templates.get((msg_type, paths))
+    if template is None:
+        template = MessageTemplate(Container(type=msg_type), paths + ('ticket', ))
+        command_templates[(msg_type, paths)] = template
+    return template
+
+
+class StatusWatcher():
+    def __init__(self, path, callback):
+        self.path = path
+        self.elements = parse_path(path)
+        self.channel = self.elements.pop(0)
+        self.callback = callback
+
 
 class ApplicationStatus():
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, snapshots=False, channels=None, lazy=False,
+                 idle_timeout=0.0, arrays=False):
         self.threads = []
         self.shutdown = threading.Event()
-        self.timer_lock = threading.Lock()
+        self.scheduler = TimerScheduler()  # heartbeat deadlines, serviced by the socket worker
         self.config_condition = threading.Condition(threading.Lock())
         self.io_condition = threading.Condition(threading.Lock())
         self.motion_condition = threading.Condition(threading.Lock())
@@ -80,9 +111,12 @@ class ApplicationStatus():
         self.connected_condition = threading.Condition(threading.Lock())
         self.synced_condition = threading.Condition(threading.Lock())
         self.debug = debug
+        self.snapshots = snapshots  # publish immutable snapshots instead of updating in place
+        self.arrays = arrays  # keep NumPy views such as motion.position_array
         self.is_ready = False
 
-        # callbacks
+        # callbacks, run by the dispatcher
+        self.dispatcher = default_dispatcher
         self.on_synced_changed = []
         self.on_connected_changed = []
 
@@ -90,27 +124,58 @@ class ApplicationStatus():
         self.connected = False
         self.state = 'Disconnected'
         self.status_state = 'Down'
-        self.channels = set(['motion', 'config', 'io', 'task', 'interp'])
+        self.channel_fields = {'motion': ('emc_status_motion', self.update_motion),
+                               'config': ('emc_status_config', self.update_config),
+                               'io': ('emc_status_io', self.update_io),
+                               'task': ('emc_status_task', self.update_task),
+                               'interp': ('emc_status_interp', self.update_interp)}
+        self.channel_conditions = {'motion': self.motion_condition,
+                                   'config': self.config_condition,
+                                   'io': self.io_condition,
+                                   'task': self.task_condition,
+                                   'interp': self.interp_condition}
         self.running = False
 
+        # channel selection, lazy mode subscribes a channel on first access
+        # and drops it again after idle_timeout seconds without access
+        if channels is None:
+            channels = [] if lazy else self.channel_fields.keys()
+        for channel in channels:
+            if channel not in self.channel_fields:
+                raise ValueError('unknown status channel %s' % channel)
+        self.channels = set(channels)  # replaced, not modified, on change
+        self.pinned_channels = set(channels)
+        self.lazy = lazy
+        self.idle_timeout = idle_timeout
+        self.channel_access = {}
+        self.idle_check_time = 0.0
+        self.subscription_lock = threading.Lock()
+        self.pending_subscriptions = set()
+        self.pending_unsubscriptions = set()
+
         # more efficient to reuse a protobuf message
         self.rx = Container()
+        self.channel_plans = {}
+        for channel, (field_name, _) in self.channel_fields.items():
+            self.channel_plans[channel] = get_decode_plan(getattr(self.rx, field_name).DESCRIPTOR)
 
         # status containers, also used to expose data
+        self.generations = {}  # increased with every applied update
+        self.channel_snapshots = {}  # (generation, data) per channel
+        self.watcher_lock = threading.Lock()
+        self.watchers = {}  # tuple of watchers per channel, replaced on change
         self.io_data = None
         self.config_data = None
         self.motion_data = None
         self.task_data = None
         self.interp_data = None
-        self.initialize_object('io')
-        self.initialize_object('config')
-        self.initialize_object('motion')
-        self.initialize_object('task')
-        self.initialize_object('interp')
+        for channel in self.channel_fields:
+            with self.channel_conditions[channel]:
+                self.initialize_object(channel)
 
         self.status_uri = ''
         self.status_period = 0
-        self.status_timer = None
+        self.status_timer = HeartbeatTimer(self.scheduler, self.status_timer_tick)
         self.subscriptions = set()
         self.synced_channels = set()
 
@@ -122,31 +187,43 @@ class ApplicationStatus():
         self.sockets_connected = False
 
     # make sure locks are used when accessing properties
-    # should we return a copy instead of the reference?
+    # in snapshot mode the returned objects are never modified
     @property
     def io(self):
-        with self.io_condition:
-            return self.io_data
+        return self.get_data('io')
 
     @property
     def config(self):
-        with self.config_condition:
-            return self.config_data
+        return self.get_data('config')
 
     @property
     def motion(self):
-        with self.motion_condition:
-            return self.motion_data
+        return self.get_data('motion')
 
     @property
     def task(self):
-        with self.task_condition:
-            return self.task_data
+        return self.get_data('task')
 
     @property
     def interp(self):
-        with self.interp_condition:
-            return self.interp_data
+        return self.get_data('interp')
+
+    def get_data(self, channel):
+        if self.lazy:
+            self.channel_access[channel] = time.time()
+            if channel not in self.channels:
+                self.add_channel(channel)
+        if self.snapshots:
+            return self.channel_snapshots[channel][1]
+        with self.channel_conditions[channel]:
+            return getattr(self, '%s_data' % channel)
+
+    # returns a consistent (generation, data) tuple without taking a lock,
+    # the data must be treated as read-only
+    def get_snapshot(self, channel):
+        if not self.snapshots:
+            raise RuntimeError('snapshots are not enabled')
+        return self.channel_snapshots[channel]
 
     def wait_connected(self, timeout=None):
         with self.connected_condition:
@@ -162,38 +239,139 @@ class ApplicationStatus():
             self.synced_condition.wait(timeout=timeout)
             return self.synced
 
+    def channel_synced(self, channel):
+        with self.synced_condition:
+            return channel in self.synced_channels
+
+    def wait_channel_synced(self, channel, timeout=None):
+        with self.synced_condition:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while channel not in self.synced_channels:
+                if timeout is None:
+                    self.synced_condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0.0:
+                        return False
+                    self.synced_condition.wait(timeout=remaining)
+            return True
+
+    # subscribes an additional channel, also while running
+    def add_channel(self, channel):
+        if channel not in self.channel_fields:
+            raise ValueError('unknown status channel %s' % channel)
+        with self.subscription_lock:
+            if channel in self.channels:
+                return
+            self.channels = self.channels | set([channel])
+            self.pending_unsubscriptions.discard(channel)
+            self.pending_subscriptions.add(channel)
+        self.update_synced()
+
+    def remove_channel(self, channel):
+        with self.subscription_lock:
+            if channel not in self.channels:
+                return
+            self.channels = self.channels - set([channel])
+            self.pending_subscriptions.discard(channel)
+            self.pending_unsubscriptions.add(channel)
+
+    # applies subscription changes, socket options are only set by the worker
+    def update_subscriptions(self):
+        now = time.time()
+        if self.lazy and self.idle_timeout > 0.0 and now - self.idle_check_time > 1.0:
+            self.idle_check_time = now
+            for channel in self.channels - self.pinned_channels:
+                if self.watchers.get(channel):
+                    continue  # watched channels are in use
+                if len(self.channels) <= 1:
+                    break  # without a subscription no heartbeat arrives
+                if self.channel_access.get(channel, 0.0) < (now - self.idle_timeout):
+                    self.remove_channel(channel)
+
+        with self.subscription_lock:
+            subscribe = self.pending_subscriptions
+            unsubscribe = self.pending_unsubscriptions
+            self.pending_subscriptions = set()
+            self.pending_unsubscriptions = set()
+
+        for channel in unsubscribe:
+            if channel in self.subscriptions:
+                self.status_socket.setsockopt(zmq.UNSUBSCRIBE, channel)
+                self.subscriptions.discard(channel)
+            with self.synced_condition:
+                self.synced_channels.discard(channel)
+            self.reset_channel(channel)
+        if self.status_state != 'Down':
+            for channel in subscribe:
+                if channel not in self.subscriptions:
+                    self.status_socket.setsockopt(zmq.SUBSCRIBE, channel)  # triggers a full update
+                    self.subscriptions.add(channel)
+        elif not self.subscriptions and self.channels:
+            self.subscribe()  # no ping arrives to trigger the subscribe
+        elif subscribe:
+            with self.subscription_lock:  # applied by the next subscribe
+                self.pending_subscriptions |= subscribe & self.channels
+        if unsubscribe:
+            self.update_synced()
+
     def wait_config_updated(self, timeout=None):
-        with self.config_condition:
-            self.config_condition.wait(timeout=timeout)
+        return self.wait_for_generation('config', timeout=timeout) is not None
 
     def wait_io_updated(self, timeout=None):
-        with self.io_condition:
-            self.io_condition.wait(timeout=timeout)
+        return self.wait_for_generation('io', timeout=timeout) is not None
 
     def wait_motion_updated(self, timeout=None):
-        with self.motion_condition:
-            self.motion_condition.wait(timeout=timeout)
+        return self.wait_for_generation('motion', timeout=timeout) is not None
 
     def wait_task_updated(self, timeout=None):
-        with self.task_condition:
-            self.task_condition.wait(timeout=timeout)
+        return self.wait_for_generation('task', timeout=timeout) is not None
 
     def wait_interp_updated(self, timeout=None):
-        with self.interp_condition:
-            self.interp_condition.wait(timeout=timeout)
+        return self.wait_for_generation('interp', timeout=timeout) is not None
+
+    def generation(self, channel):
+        with self.channel_conditions[channel]:
+            return self.generations[channel]
+
+    # waits until the channel generation is newer than after, all waiters
+    # are woken up by an update, returns the generation or None on timeout
+    def wait_for_generation(self, channel, after=None, timeout=None):
+        condition = self.channel_conditions[channel]
+        with condition:
+            if after is None:
+                after = self.generations[channel]
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while self.generations[channel] <= after:
+                if timeout is None:
+                    condition.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0.0:
+                        return None
+                    condition.wait(timeout=remaining)
+            return self.generations[channel]
 
     def socket_worker(self):
         poll = zmq.Poller()
         poll.register(self.status_socket, zmq.POLLIN)
 
         while not self.shutdown.is_set():
-            s = dict(poll.poll(200))
+            s = dict(poll.poll(self.scheduler.timeout()))
             if self.status_socket in s and s[self.status_socket] == zmq.POLLIN:
                 self.process_status()
+            self.scheduler.run()
+            if self.pending_subscriptions or self.pending_unsubscriptions or self.lazy:
+                self.update_subscriptions()
 
     def process_status(self):
-        (topic, msg) = self.status_socket.recv_multipart()
-        self.rx.ParseFromString(msg)
+        (topic, msg) = self.status_socket.recv_multipart(copy=False)
+        topic = topic.bytes
+        if topic not in self.subscriptions:  # unsubscribed meanwhile, skip parsing
+            return
+        self.rx.ParseFromString(msg.buffer)  # parse from the frame without a copy
 
         if self.debug:
             print('[status] received message: %s' % topic)
@@ -202,30 +380,13 @@ class ApplicationStatus():
         if self.rx.type == MT_EMCSTAT_FULL_UPDATE \
            or self.rx.type == MT_EMCSTAT_INCREMENTAL_UPDATE:
 
-            if topic == 'motion' and self.rx.HasField('emc_status_motion'):
-                self.update_motion(self.rx.emc_status_motion)
-                if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
-                    self.update_sync('motion')
-
-            if topic == 'config' and self.rx.HasField('emc_status_config'):
-                self.update_config(self.rx.emc_status_config)
-                if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
-                    self.update_sync('config')
-
-            if topic == 'io' and self.rx.HasField('emc_status_io'):
-                self.update_io(self.rx.emc_status_io)
-                if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
-                    self.update_sync('io')
-
-            if topic == 'task' and self.rx.HasField('emc_status_task'):
-                self.update_task(self.rx.emc_status_task)
-                if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
-                    self.update_sync('task')
-
-            if topic == 'interp' and self.rx.HasField('emc_status_interp'):
-                self.update_interp(self.rx.emc_status_interp)
-                if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
-                    self.update_sync('interp')
+            channel = self.channel_fields.get(topic)
+            if channel is not None:
+                field_name, update_func = channel
+                if self.rx.HasField(field_name):
+                    update_func(getattr(self.rx, field_name))
+                    if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
+                        self.update_sync(topic)
 
             if self.rx.type == MT_EMCSTAT_FULL_UPDATE:
                 if not self.status_state == 'Up':
@@ -249,98 +410,159 @@ class ApplicationStatus():
             print('[status] received unrecognized message type')
 
     def initialize_object(self, channel):
-        if channel == 'io':
-            self.io_data = MessageObject()
-            recurse_descriptor(self.rx.emc_status_io.DESCRIPTOR, self.io_data)
-        elif channel == 'config':
-            self.config_data = MessageObject()
-            recurse_descriptor(self.rx.emc_status_config.DESCRIPTOR, self.config_data)
-        elif channel == 'motion':
-            self.motion_data = MessageObject()
-            recurse_descriptor(self.rx.emc_status_motion.DESCRIPTOR, self.motion_data)
-        elif channel == 'task':
-            self.task_data = MessageObject()
-            recurse_descriptor(self.rx.emc_status_task.DESCRIPTOR, self.task_data)
-        elif channel == 'interp':
-            self.interp_data = MessageObject()
-            recurse_descriptor(self.rx.emc_status_interp.DESCRIPTOR, self.interp_data)
+        data = getattr(self, '%s_data' % channel)
+        plan = self.channel_plans[channel]
+        if self.snapshots and not self.arrays:
+            data = plan.prototype  # never modified, can be shared
+        elif self.snapshots or data is None:
+            data = plan.new_object()
+            if self.arrays:
+                plan.attach_arrays(data)
+        else:
+            plan.reset_object(data)  # cheaper than rebuilding the object
+        self.publish(channel, data)
+
+    # must be called with the channel condition acquired
+    def publish(self, channel, data):
+        generation = self.generations.get(channel, 0) + 1
+        self.generations[channel] = generation
+        setattr(self, '%s_data' % channel, data)
+        if self.snapshots:
+            self.channel_snapshots[channel] = (generation, data)
+        self.channel_conditions[channel].notify_all()
+
+    def reset_channel(self, channel):
+        with self.channel_conditions[channel]:
+            self.initialize_object(channel)
+        self.notify_watchers(channel, [channel])
+
+    def update_channel(self, channel, data):
+        changes = None
+        if self.watchers.get(channel):
+            changes = []  # only track changes when someone is interested
+        condition = self.channel_conditions[channel]
+        with condition:
+            obj = getattr(self, '%s_data' % channel)
+            if self.snapshots:
+                obj = recurse_message_copy(data, obj, changes, channel)
+            else:
+                recurse_message(data, obj, changes=changes, prefix=channel)
+            self.publish(channel, obj)
+        if changes:
+            self.notify_watchers(channel, changes)
+
+    # calls watcher callbacks with the new value, once per update
+    def notify_watchers(self, channel, changes):
+        data = getattr(self, '%s_data' % channel)
+        for watcher in self.watchers.get(channel, ()):
+            for changed_path in changes:
+                if path_affected(watcher.path, changed_path):
+                    try:
+                        value = resolve_path(data, watcher.elements)
+                    except (IndexError, AttributeError):
+                        value = None
+                    self.dispatcher.dispatch((watcher.callback, ), (value, ), watcher)
+                    break
+
+    # registers a callback for a field path such as motion.position.x,
+    # task.task_state or io.tool_table[3], called only when the value changed
+    def watch(self, path, callback):
+        watcher = StatusWatcher(path, callback)
+        if watcher.channel not in self.channel_fields:
+            raise ValueError('unknown status channel %s' % watcher.channel)
+        if self.lazy:
+            self.add_channel(watcher.channel)  # otherwise it never fires
+        with self.watcher_lock:
+            watchers = self.watchers.get(watcher.channel, ())
+            self.watchers[watcher.channel] = watchers + (watcher, )
+        return watcher
+
+    def unwatch(self, watcher):
+        with self.watcher_lock:
+            watchers = self.watchers.get(watcher.channel, ())
+            self.watchers[watcher.channel] = tuple(w for w in watchers if w is not watcher)
+
+    # waits until predicate(self) is true, the predicate is only re-evaluated
+    # when one of the field paths changed, defaults to all channels
+    def wait_until(self, predicate, paths=None, timeout=None):
+        if paths is None:
+            paths = list(self.channel_fields)
+        changed = threading.Event()
+        watchers = [self.watch(path, lambda value: changed.set()) for path in paths]
+        try:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while True:
+                changed.clear()
+                if predicate(self):
+                    return True
+                if timeout is None:
+                    changed.wait()
+                else:
+                    remaining = end_time - time.time()
+                    if remaining <= 0.0:
+                        return False
+                    changed.wait(remaining)
+        finally:
+            for watcher in watchers:
+                self.unwatch(watcher)
 
     def update_motion(self, data):
-        with self.motion_condition:
-            recurse_message(data, self.motion_data)
-            self.motion_condition.notify()
+        self.update_channel('motion', data)
 
     def update_config(self, data):
-        with self.config_condition:
-            recurse_message(data, self.config_data)
-            self.config_condition.notify()
+        self.update_channel('config', data)
 
     def update_io(self, data):
-        with self.io_condition:
-            recurse_message(data, self.io_data)
-            self.io_condition.notify()
+        self.update_channel('io', data)
 
     def update_task(self, data):
-        with self.task_condition:
-            recurse_message(data, self.task_data)
-            self.update_running()
-            self.task_condition.notify()
+        self.update_channel('task', data)
+        self.update_running()
 
     def update_interp(self, data):
-        with self.interp_condition:
-            recurse_message(data, self.interp_data)
-            self.update_running()
-            self.interp_condition.notify()
+        self.update_channel('interp', data)
+        self.update_running()
 
     def update_sync(self, channel):
-        self.synced_channels.add(channel)
+        with self.synced_condition:
+            self.synced_channels.add(channel)
+        self.update_synced()
 
-        if self.synced_channels == self.channels:
-            with self.synced_condition:
-                self.synced = True
-                self.synced_condition.notify()
-            for func in self.on_synced_changed:
-                func(True)
+    # synced once every selected channel received a full update
+    def update_synced(self):
+        with self.synced_condition:
+            channels = self.channels
+            synced = len(channels) > 0 and channels.issubset(self.synced_channels)
+            changed = synced != self.synced
+            self.synced = synced
+            self.synced_condition.notify_all()
+        if changed:
+            self.dispatcher.dispatch(self.on_synced_changed, (synced, ), (self, 'synced'))
 
     def clear_sync(self):
         with self.synced_condition:
             self.synced = False
-            self.synced_condition.notify()
-        self.synced_channels.clear()
-        for func in self.on_synced_changed:
-            func(False)
+            self.synced_channels.clear()
+            self.synced_condition.notify_all()
+        self.dispatcher.dispatch(self.on_synced_changed, (False, ), (self, 'synced'))
 
     def status_timer_tick(self):
         self.status_state = 'Down'
         self.update_state('Timeout')
 
     def start_status_heartbeat(self, interval):
-        self.timer_lock.acquire()
-        if self.status_timer:
-            self.status_timer.cancel()
-
         self.status_period = interval
         if interval > 0:
-            self.status_timer = threading.Timer(interval / 1000,
-                                                self.status_timer_tick)
-            self.status_timer.start()
-        self.timer_lock.release()
+            self.status_timer.start(interval)
+        else:
+            self.status_timer.stop()
 
     def refresh_status_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.status_timer:
-            self.status_timer.cancel()
-            self.status_timer = threading.Timer(self.status_period / 1000,
-                                                self.status_timer_tick)
-            self.status_timer.start()
-        self.timer_lock.release()
+        self.status_timer.refresh()  # only moves the deadline
 
     def stop_status_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.status_timer:
-            self.status_timer.cancel()
-            self.status_timer = None
-        self.timer_lock.release()
+        self.status_timer.stop()
 
     def update_state(self, state):
         if state != self.state:
@@ -350,8 +572,7 @@ class ApplicationStatus():
                     self.connected = True
                     self.connected_condition.notify()
                 print('[status] connected')
-                for func in self.on_connected_changed:
-                    func(True)
+                self.dispatcher.dispatch(self.on_connected_changed, (True, ), (self, 'connected'))
             elif self.connected:
                 with self.connected_condition:
                     self.connected = False
@@ -360,23 +581,16 @@ class ApplicationStatus():
                 self.clear_sync()
                 self.status_period = 0  # stop heartbeat
                 if not state == 'Timeout':  # clear in case we have no timeout
-                    with self.motion_condition:
-                        self.initialize_object('motion')
-                    with self.config_condition:
-                        self.initialize_object('config')
-                    with self.io_condition:
-                        self.initialize_object('io')
-                    with self.task_condition:
-                        self.initialize_object('task')
-                    with self.interp_condition:
-                        self.initialize_object('interp')
+                    for channel in self.channels:
+                        self.reset_channel(channel)
                 print('[status] disconnected')
-                for func in self.on_connected_changed:
-                    func(False)
+                self.dispatcher.dispatch(self.on_connected_changed, (False, ), (self, 'connected'))
 
     def subscribe(self):
         self.status_state = 'Trying'
 
+        with self.subscription_lock:
+            self.pending_subscriptions.clear()  # all selected channels are subscribed now
         for channel in self.channels:
             self.status_socket.setsockopt(zmq.SUBSCRIBE, channel)
             self.subscriptions.add(channel)
@@ -386,21 +600,7 @@ class ApplicationStatus():
 
         for subscription in self.subscriptions:
             self.status_socket.setsockopt(zmq.UNSUBSCRIBE, subscription)
-            if subscription == 'motion':
-                with self.motion_condition:
-                    self.initialize_object('motion')
-            elif subscription == 'config':
-                with self.config_condition:
-                    self.initialize_object('config')
-            elif subscription == 'io':
-                with self.io_condition:
-                    self.initialize_object('io')
-            elif subscription == 'task':
-                with self.task_condition:
-                    self.initialize_object('lock')
-            elif subscription == 'interp':
-                with self.interp_condition:
-                    self.initialize_object('interp')
+            self.reset_channel(subscription)
 
         self.subscriptions.clear()
 
@@ -454,6 +654,16 @@ class ApplicationStatus():
             self.start()
 
 
+class CommandFuture(Future):
+    """Outcome of a command ticket, done once the command completed.
+    The executed future is done as soon as the command was executed."""
+    def __init__(self, ticket, msg_type):
+        Future.__init__(self)
+        self.ticket = ticket
+        self.msg_type = msg_type
+        self.executed = Future(self.condition)
+
+
 class ApplicationCommand():
 
     def __init__(self, debug=False):
@@ -466,7 +676,8 @@ class ApplicationCommand():
         self.debug = debug
         self.is_ready = False
 
-        # callbacks
+        # callbacks, run by the dispatcher
+        self.dispatcher = default_dispatcher
         self.on_connected_changed = []
 
         self.connected = False
@@ -477,13 +688,34 @@ class ApplicationCommand():
         self.heartbeat_period = 3000
         self.ping_error_count = 0
         self.ping_error_threshold = 2
-        self.heartbeat_timer = None
+        self.scheduler = TimerScheduler()  # heartbeat deadlines, serviced by the socket worker
+        self.heartbeat_timer = HeartbeatTimer(self.scheduler, self.heartbeat_timer_tick)
         self.ticket = 1  # stores the local ticket number
         self.executed_ticket = 0  # last tick number from executed feedback
         self.completed_ticket = 0  # last tick number from executed feedback
         self.executed_updated = False
         self.completed_updated = False
 
+        # command futures, guarded by the tx lock
+        self.inflight = {}  # ticket -> CommandFuture of commands waiting for completion
+        self.finished_commands = collections.OrderedDict()  # recently finished futures
+        self.finished_size = 1000
+        self.inflight_condition = threading.Condition(self.tx_lock)
+        # maximum of outstanding commands, 0 means unbounded, the bound keeps
+        # the commands queued in ZeroMQ few so the priority lane overtakes the rest
+        self.max_inflight = 32
+        self.inflight_timeout = None  # seconds to wait for a free slot, None waits forever
+        self.send_ticket = 1  # next ticket allowed on the wire, keeps the command order
+        self.skipped_tickets = set()  # tickets that will never wait for their turn
+        self.priority_lane = True  # abort, estop and jog stops overtake queued commands
+        self.send_barriers = []  # (ticket, tag, error), earlier waiting commands are dropped
+
+        # setpoint channel for continuously varying commands, e.g. jogs and overrides
+        self.max_setpoint_rate = 0.0  # Hz per setpoint key, 0 sends every setpoint immediately
+        self.setpoint_lock = threading.Lock()  # held by the worker while it sends setpoints
+        self.pending_setpoints = {}  # key -> (func, args), only the newest value is kept
+        self.setpoint_sent = {}  # key -> last send time
+
         # more efficient to reuse a protobuf message
         self.rx = Container()
         self.tx = Container()
@@ -497,8 +729,22 @@ class ApplicationCommand():
         self.command_socket.setsockopt(zmq.LINGER, 0)
         self.command_socket.setsockopt(zmq.IDENTITY, client_id)
         self.sockets_connected = False
-
-    def send_command_msg(self, msg_type):
+        # messages from other threads, sent by the socket worker
+        self.send_queue = collections.deque()
+        # sent before anything of the normal lane, but on the same socket, a
+        # second connection would let the service run older commands after it
+        self.priority_queue = collections.deque()
+        self.queue_lock = threading.Lock()
+        wakeup_uri = 'inproc://command-wakeup-%s' % uuid.uuid4()
+        self.wakeup_receiver = self.context.socket(zmq.PAIR)
+        self.wakeup_receiver.bind(wakeup_uri)
+        self.wakeup_sender = self.context.socket(zmq.PAIR)
+        self.wakeup_sender.connect(wakeup_uri)
+
+    # priority commands skip the flow control and the queued commands of
+    # the normal lane, the tag names the queued commands for dropping them,
+    # callers drop the overtaken commands first with take_queued_commands
+    def send_command_msg(self, msg_type, priority=False, tag=None):
         ticket = self.ticket
         self.tx.type = msg_type
         if msg_type != MT_PING:  # no need to add a ticket to a ping
@@ -507,18 +753,261 @@ class ApplicationCommand():
         if self.debug:
             print('[command] sending message: %s' % msg_type)
             print(str(self.tx))
-        self.command_socket.send(self.tx.SerializeToString(), zmq.NOBLOCK)
+        data = self.tx.SerializeToString()
         self.tx.Clear()
+        if msg_type == MT_PING:
+            self.send_data(None, data)
+            return ticket
+        return self.send_command_data(ticket, msg_type, data, priority, tag)
+
+    # sends a pre-encoded command, the values fill the template paths
+    # and the ticket is appended as the last field
+    def send_template(self, template, values=(), priority=False, tag=None):
+        msg_type = template.message.type
+        if msg_type == MT_PING:  # no need to add a ticket to a ping
+            data = template.encode()
+            ticket = self.ticket
+        else:
+            ticket = self.ticket
+            data = template.encode(values + (ticket, ))  # a value error must not use up the ticket
+            self.ticket += 1
+        if self.debug:
+            print('[command] sending message: %s' % msg_type)
+            print(str(Container.FromString(data)))
+        if msg_type == MT_PING:
+            self.send_data(None, data)
+            return ticket
+        return self.send_command_data(ticket, msg_type, data, priority, tag)
+
+    def send_command_data(self, ticket, msg_type, data, priority, tag):
+        future = CommandFuture(ticket, msg_type)
+        priority = priority and self.priority_lane
+        try:
+            if not priority:
+                self.wait_inflight_slot(ticket, tag)
+            self.send_data(ticket, data, priority, tag)
+            if msg_type in UNANSWERED_COMMANDS:  # would hold an in-flight slot forever
+                self.remember_finished(ticket, future)
+                future.executed.set_result(ticket)
+                future.set_result(ticket)
+            else:
+                self.inflight[ticket] = future
+        finally:
+            self.advance_send_ticket(ticket)
         return ticket
 
+    # ZeroMQ sockets are not thread safe, sending from another thread while
+    # the worker polls loses wakeups, so other threads queue their messages
+    def send_data(self, ticket, data, priority=False, tag=None):
+        if not self.threads or threading.current_thread() in self.threads:
+            self.command_socket.send(data, zmq.NOBLOCK)
+            return
+        queue = self.priority_queue if priority else self.send_queue
+        queue.append((ticket, data, tag))
+        if len(queue) == 1:  # otherwise the worker is already woken up
+            self.wakeup_sender.send(b'', zmq.NOBLOCK)
+
+    def send_queued(self):
+        while True:
+            try:
+                self.wakeup_receiver.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while self.priority_queue or self.send_queue:
+            with self.queue_lock:
+                if self.priority_queue:  # checked before every command of the normal lane
+                    ticket, data, _ = self.priority_queue.popleft()
+                elif self.send_queue:
+                    ticket, data, _ = self.send_queue.popleft()
+                else:
+                    break  # dropped meanwhile
+            try:
+                self.command_socket.send(data, zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                if ticket is not None:
+                    self.finish_command(ticket, RemoteError('sending failed: %s' % e))
+
+    # removes the commands of the normal lane that are not sent yet, all of
+    # them or those with the given tag, commands still waiting for their
+    # slot raise the error, the caller holds the tx lock and fails the
+    # returned tickets once the overtaking command is sent
+    def take_queued_commands(self, error, tag=None):
+        dropped = []
+        with self.queue_lock:
+            kept = collections.deque()
+            for entry in self.send_queue:
+                if entry[0] is not None and (tag is None or entry[2] == tag):
+                    dropped.append(entry[0])
+                else:
+                    kept.append(entry)
+            self.send_queue = kept
+        self.send_barriers.append((self.ticket, tag, error))
+        self.inflight_condition.notify_all()
+        return dropped
+
+    def fail_tickets(self, tickets, error):
+        for ticket in tickets:
+            self.finish_command(ticket, error)
+
+    # fails the commands waiting in the normal lane queue, all of them or
+    # those with the given tag
+    def drop_queued_commands(self, error, tag=None):
+        with self.tx_lock:
+            dropped = self.take_queued_commands(error, tag)
+        self.fail_tickets(dropped, error)
+        return len(dropped)
+
+    def wake_worker(self):
+        if self.threads and threading.current_thread() not in self.threads:
+            with self.tx_lock:
+                self.wakeup_sender.send(b'', zmq.NOBLOCK)
+
+    def next_setpoint_time(self, key):
+        if self.max_setpoint_rate <= 0.0:
+            return 0.0  # rate limit was disabled meanwhile
+        return self.setpoint_sent.get(key, 0.0) + 1.0 / self.max_setpoint_rate
+
+    # returns True if func(*args) was stored and will be sent by the socket
+    # worker once the key may send again, False if the caller sends it now
+    def defer_setpoint(self, key, func, args):
+        if self.max_setpoint_rate <= 0.0:
+            return False
+        with self.setpoint_lock:
+            now = time.time()
+            if key not in self.pending_setpoints and now >= self.next_setpoint_time(key):
+                self.setpoint_sent[key] = now
+                return False
+            new_key = key not in self.pending_setpoints
+            self.pending_setpoints[key] = (func, args)
+        if new_key:
+            self.wake_worker()  # the key may be due before the current poll timeout
+        return True
+
+    # drops a pending setpoint, a setpoint being sent by the worker is on
+    # the wire before this returns
+    def cancel_setpoint(self, key):
+        with self.setpoint_lock:
+            self.pending_setpoints.pop(key, None)
+
+    def flush_setpoints(self):
+        with self.setpoint_lock:
+            now = time.time()
+            for key, (func, args) in list(self.pending_setpoints.items()):
+                if now >= self.next_setpoint_time(key):
+                    del self.pending_setpoints[key]
+                    self.setpoint_sent[key] = now
+                    if not self.connected:
+                        continue
+                    try:
+                        func(*args)
+                    except (ValueError, TypeError, RemoteError) as e:  # must not stop the worker
+                        print('[command] error: setpoint %s not sent: %s' % (key[0], e))
+
+    # blocks until the ticket may be sent, called with the tx lock held
+    # waiting releases the tx lock, so pings and replies keep flowing
+    def wait_inflight_slot(self, ticket, tag=None):
+        if self.max_inflight <= 0 or threading.current_thread() in self.threads:
+            return  # never block the socket worker
+        if self.inflight_timeout is not None:
+            end_time = time.time() + self.inflight_timeout
+        while len(self.inflight) >= self.max_inflight or self.send_ticket != ticket:
+            for barrier_ticket, barrier_tag, error in self.send_barriers:
+                if ticket < barrier_ticket and (barrier_tag is None or barrier_tag == tag):
+                    raise error  # overtaken by an abort, estop or jog stop
+            remaining = None
+            if self.inflight_timeout is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0.0:
+                    raise RemoteTimeout('%i commands in flight' % len(self.inflight))
+            self.inflight_condition.wait(timeout=remaining)
+
+    def advance_send_ticket(self, ticket):
+        if ticket != self.send_ticket:
+            self.skipped_tickets.add(ticket)  # an earlier ticket is still waiting
+            return
+        ticket += 1
+        while ticket in self.skipped_tickets:
+            self.skipped_tickets.remove(ticket)
+            ticket += 1
+        self.send_ticket = ticket
+        if self.send_barriers:  # no earlier command is waiting anymore
+            self.send_barriers = [b for b in self.send_barriers if b[0] > ticket]
+        self.inflight_condition.notify_all()
+
+    # returns the future of a sent command, None if the ticket is unknown
+    def command_future(self, ticket):
+        with self.inflight_condition:
+            future = self.inflight.get(ticket)
+            if future is None:
+                future = self.finished_commands.get(ticket)
+            return future
+
+    # waits until all tickets completed, returns False on timeout
+    def wait_tickets(self, tickets, timeout=None):
+        futures = [self.command_future(ticket) for ticket in tickets]
+        return wait_futures([f for f in futures if f is not None], timeout)
+
+    def finish_command(self, ticket, error=None):
+        with self.inflight_condition:
+            future = self.inflight.pop(ticket, None)
+            if future is None:
+                return
+            self.remember_finished(ticket, future)
+            self.inflight_condition.notify_all()
+        if error is None:
+            future.executed.set_result(ticket)
+            future.set_result(ticket)
+        else:
+            future.executed.set_exception(error)
+            future.set_exception(error)
+
+    # called with the tx lock held
+    def remember_finished(self, ticket, future):
+        self.finished_commands[ticket] = future
+        if len(self.finished_commands) > self.finished_size:
+            self.finished_commands.popitem(last=False)
+
+    def fail_commands(self, error):
+        with self.inflight_condition:
+            tickets = sorted(self.inflight)
+        for ticket in tickets:
+            self.finish_command(ticket, error)
+
+    # errors without reply ticket belong to the oldest command not yet executed
+    def error_ticket(self, rx):
+        if rx.HasField('reply_ticket'):
+            return rx.reply_ticket
+        with self.inflight_condition:
+            pending = [t for t, f in self.inflight.items() if not f.executed.done()]
+            pending = pending or list(self.inflight)
+        if not pending:
+            return None
+        return min(pending)
+
     def socket_worker(self):
         poll = zmq.Poller()
         poll.register(self.command_socket, zmq.POLLIN)
+        poll.register(self.wakeup_receiver, zmq.POLLIN)
 
         while not self.shutdown_event.is_set():
-            s = dict(poll.poll(200))
+            s = dict(poll.poll(self.poll_timeout()))
             if self.command_socket in s:
                 self.process_command()
+            if self.wakeup_receiver in s:
+                self.send_queued()
+            if self.pending_setpoints:
+                self.flush_setpoints()
+            self.scheduler.run()
+
+    def poll_timeout(self):
+        timeout = self.scheduler.timeout()
+        with self.setpoint_lock:
+            if self.pending_setpoints:
+                now = time.time()
+                for key in self.pending_setpoints:
+                    remaining = (self.next_setpoint_time(key) - now) * 1000
+                    timeout = min(timeout, max(0, int(remaining) + 1))
+        return timeout
 
     def process_command(self):
         msg = self.command_socket.recv()
@@ -536,24 +1025,39 @@ class ApplicationCommand():
 
         elif self.rx.type == MT_ERROR:
             self.update_error('Service', self.rx.note)
+            ticket = self.error_ticket(self.rx)
+            if ticket is not None:
+                self.finish_command(ticket, RemoteError('; '.join(self.rx.note)))
             # should we disconnect here?
 
         elif self.rx.type == MT_EMCCMD_EXECUTED:
+            ticket = self.rx.reply_ticket
             with self.executed_condition:
-                self.executed_ticket = self.rx.reply_ticket
+                self.executed_ticket = ticket
                 self.executed_updated = True
-                self.executed_condition.notify()
+                self.executed_condition.notify_all()
+            with self.inflight_condition:
+                future = self.inflight.get(ticket)
+            if future is not None:
+                future.executed.set_result(ticket)
 
         elif self.rx.type == MT_EMCCMD_COMPLETED:
+            ticket = self.rx.reply_ticket
             with self.completed_condition:
-                self.completed_ticket = self.rx.reply_ticket
+                self.completed_ticket = ticket
                 self.completed_updated = True
-                self.completed_condition.notify()
+                self.completed_condition.notify_all()
+            self.finish_command(ticket)
 
         else:
             print('[command] received unsupported message')
 
     def wait_executed(self, ticket=None, timeout=None):
+        if ticket:
+            future = self.command_future(ticket)
+            if future is not None:
+                return future.executed.wait(timeout) and future.executed.error is None
+
         with self.executed_condition:
             if ticket and ticket <= self.executed_ticket:  # very likely that we already received the reply
                 return True
@@ -567,8 +1071,13 @@ class ApplicationCommand():
                     return True
 
     def wait_completed(self, ticket=None, timeout=None):
+        if ticket:
+            future = self.command_future(ticket)
+            if future is not None:
+                return future.wait(timeout) and future.error is None
+
         with self.completed_condition:
-            if ticket and ticket < self.completed_ticket:  # very likely that we already received the reply
+            if ticket and ticket <= self.completed_ticket:  # very likely that we already received the reply
                 return True
 
             while True:
@@ -597,7 +1106,7 @@ class ApplicationCommand():
                 thread.start()
             self.start_command_heartbeat()
             with self.tx_lock:
-                self.send_command_msg(MT_PING)
+                self.send_template(ping_template)
 
     def stop(self):
         self.is_ready = False
@@ -605,6 +1114,10 @@ class ApplicationCommand():
         for thread in self.threads:
             thread.join()
         self.threads = []
+        self.send_queue.clear()
+        self.priority_queue.clear()
+        with self.setpoint_lock:
+            self.pending_setpoints.clear()
         self.cleanup()
         self.update_state('Disconnected')
 
@@ -636,15 +1149,15 @@ class ApplicationCommand():
                     self.connected = True
                     self.connected_condition.notify()
                 print('[command] connected')
-                for func in self.on_connected_changed:
-                    func(True)
+                self.dispatcher.dispatch(self.on_connected_changed, (True, ), (self, 'connected'))
             elif self.connected:
                 with self.connected_condition:
                     self.connected = False
                     self.connected_condition.notify()
                 print('[command] disconnected')
-                for func in self.on_connected_changed:
-                    func(False)
+                self.dispatcher.dispatch(self.on_connected_changed, (False, ), (self, 'connected'))
+            if state != 'Connected':
+                self.fail_commands(RemoteError('command channel %s' % state.lower()))
 
     def update_error(self, error, description):
         print('[command] error: %s %s' % (error, description))
@@ -657,11 +1170,9 @@ class ApplicationCommand():
             self.update_state('Timeout')
 
         with self.tx_lock:
-            self.send_command_msg(MT_PING)
+            self.send_template(ping_template)
 
-        self.heartbeat_timer = threading.Timer(self.heartbeat_period / 1000,
-                                             self.heartbeat_timer_tick)
-        self.heartbeat_timer.start()  # rearm timer
+        self.heartbeat_timer.start(self.heartbeat_period)  # rearm timer
 
     def start_command_heartbeat(self):
         if not self.connected:
@@ -670,114 +1181,108 @@ class ApplicationCommand():
         self.ping_error_count = 0  # reset heartbeat
 
         if self.heartbeat_period > 0:
-            self.heartbeat_timer = threading.Timer(self.heartbeat_period / 1000,
-                                                 self.heartbeat_timer_tick)
-            self.heartbeat_timer.start()
+            self.heartbeat_timer.start(self.heartbeat_period)
 
     def stop_command_heartbeat(self):
-        if self.heartbeat_timer:
-            self.heartbeat_timer.cancel()
-            self.heartbeat_timer = None
+        self.heartbeat_timer.stop()
 
+    # queued commands must not run after the abort and are dropped
     def abort(self, interpreter='execute'):
         if not self.connected:
             return None
 
+        error = RemoteError('dropped by abort')
         with self.tx_lock:
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_ABORT)
+            dropped = self.take_queued_commands(error)
+            template = command_template(MT_EMC_TASK_ABORT, 'interp_name')
+            ticket = self.send_template(template, (interpreter, ), priority=True)
+        self.fail_tickets(dropped, error)
+        return ticket
 
     def run_program(self, line_number, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.line_number = line_number
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_RUN)
+            template = command_template(MT_EMC_TASK_PLAN_RUN,
+                                        'emc_command_params.line_number', 'interp_name')
+            return self.send_template(template, (line_number, interpreter))
 
     def pause_program(self, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_PAUSE)
+            template = command_template(MT_EMC_TASK_PLAN_PAUSE, 'interp_name')
+            return self.send_template(template, (interpreter, ))
 
     def step_program(self, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_STEP)
+            template = command_template(MT_EMC_TASK_PLAN_STEP, 'interp_name')
+            return self.send_template(template, (interpreter, ))
 
     def resume_program(self, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_RESUME)
+            template = command_template(MT_EMC_TASK_PLAN_RESUME, 'interp_name')
+            return self.send_template(template, (interpreter, ))
 
     def reset_program(self, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_INIT)
+            template = command_template(MT_EMC_TASK_PLAN_INIT, 'interp_name')
+            return self.send_template(template, (interpreter, ))
 
     def set_task_mode(self, mode, interpreter='execute'):
         if not self.connected:
             return
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.task_mode = mode
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_SET_MODE)
+            template = command_template(MT_EMC_TASK_SET_MODE,
+                                        'emc_command_params.task_mode', 'interp_name')
+            return self.send_template(template, (mode, interpreter))
 
+    # estop drops the queued commands and takes the priority lane
     def set_task_state(self, state, interpreter='execute'):
         if not self.connected:
             return None
+        estop = state == TASK_STATE_ESTOP
+        error = RemoteError('dropped by estop')
+        dropped = []
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.task_state = state
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_SET_STATE)
+            if estop:
+                dropped = self.take_queued_commands(error)
+            template = command_template(MT_EMC_TASK_SET_STATE,
+                                        'emc_command_params.task_state', 'interp_name')
+            ticket = self.send_template(template, (state, interpreter), priority=estop)
+        self.fail_tickets(dropped, error)
+        return ticket
 
     def open_program(self, file_name, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.path = file_name
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_OPEN)
+            template = command_template(MT_EMC_TASK_PLAN_OPEN,
+                                        'emc_command_params.path', 'interp_name')
+            return self.send_template(template, (file_name, interpreter))
 
     def execute_mdi(self, command, interpreter='execute'):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.command = command
-            self.tx.interp_name = interpreter
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_EXECUTE)
+            template = command_template(MT_EMC_TASK_PLAN_EXECUTE,
+                                        'emc_command_params.command', 'interp_name')
+            return self.send_template(template, (command, interpreter))
 
     def set_spindle_brake(self, brake):
         if not self.connected:
@@ -785,9 +1290,9 @@ class ApplicationCommand():
 
         with self.tx_lock:
             if brake == ENGAGE_BRAKE:
-                return self.send_command_msg(MT_EMC_SPINDLE_BRAKE_ENGAGE)
+                return self.send_template(command_template(MT_EMC_SPINDLE_BRAKE_ENGAGE))
             elif brake == RELEASE_BRAKE:
-                return self.send_command_msg(MT_EMC_SPINDLE_BRAKE_RELEASE)
+                return self.send_template(command_template(MT_EMC_SPINDLE_BRAKE_RELEASE))
 
     def set_debug_level(self, debug_level):
         if not self.connected:
@@ -800,15 +1305,20 @@ class ApplicationCommand():
 
             return self.send_command_msg(MT_EMC_SET_DEBUG)
 
+    # returns None when the setpoint channel defers the value
     def set_feed_override(self, scale):
         if not self.connected:
             return None
+        scale = float(scale)  # a deferred value is encoded by the socket worker
+        if self.defer_setpoint(('feed_override', ), self.send_feed_override, (scale, )):
+            return None
 
-        with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.scale = scale
+        return self.send_feed_override(scale)
 
-            return self.send_command_msg(MT_EMC_TRAJ_SET_SCALE)
+    def send_feed_override(self, scale):
+        with self.tx_lock:
+            template = command_template(MT_EMC_TRAJ_SET_SCALE, 'emc_command_params.scale')
+            return self.send_template(template, (scale, ))
 
     def set_flood_enabled(self, enable):
         if not self.connected:
@@ -816,60 +1326,82 @@ class ApplicationCommand():
 
         with self.tx_lock:
             if enable:
-                return self.send_command_msg(MT_EMC_COOLANT_FLOOD_ON)
+                return self.send_template(command_template(MT_EMC_COOLANT_FLOOD_ON))
             else:
-                return self.send_command_msg(MT_EMC_COOLANT_FLOOD_OFF)
+                return self.send_template(command_template(MT_EMC_COOLANT_FLOOD_OFF))
 
     def home_axis(self, index):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = index
-
-            return self.send_command_msg(MT_EMC_AXIS_HOME)
+            template = command_template(MT_EMC_AXIS_HOME, 'emc_command_params.index')
+            return self.send_template(template, (index, ))
 
+    # continuous jogs go through the setpoint channel and return None when
+    # deferred, stops and increments drop a pending jog of the axis and are
+    # sent immediately
     def jog(self, jog_type, axis, velocity=0.0, distance=0.0):
         if not self.connected:
             return None
+        axis = int(axis)  # a deferred jog is encoded by the socket worker
+        velocity = float(velocity)
+        distance = float(distance)
+        key = ('jog', axis)
+        if jog_type != JOG_CONTINUOUS:
+            self.cancel_setpoint(key)
+        elif self.defer_setpoint(key, self.send_jog, (jog_type, axis, velocity, distance)):
+            return None
 
-        with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = axis
+        return self.send_jog(jog_type, axis, velocity, distance)
 
-            cmd_type = None
+    # a stop drops the queued jogs of its axis
+    def send_jog(self, jog_type, axis, velocity=0.0, distance=0.0):
+        error = RemoteError('dropped by jog stop')
+        dropped = []
+        with self.tx_lock:
             if jog_type == JOG_STOP:
-                cmd_type = MT_EMC_AXIS_ABORT
+                dropped = self.take_queued_commands(error, ('jog', axis))
+                template = command_template(MT_EMC_AXIS_ABORT, 'emc_command_params.index')
+                values = (axis, )
             elif jog_type == JOG_CONTINUOUS:
-                cmd_type = MT_EMC_AXIS_JOG
-                params.velocity = velocity
+                template = command_template(MT_EMC_AXIS_JOG, 'emc_command_params.index',
+                                            'emc_command_params.velocity')
+                values = (axis, velocity)
             elif jog_type == JOG_INCREMENT:
-                cmd_type = MT_EMC_AXIS_INCR_JOG
-                params.velocity = velocity
-                params.distance = distance
+                template = command_template(MT_EMC_AXIS_INCR_JOG, 'emc_command_params.index',
+                                            'emc_command_params.velocity',
+                                            'emc_command_params.distance')
+                values = (axis, velocity, distance)
             else:
-                self.tx.Clear()
                 return None
 
-            return self.send_command_msg(cmd_type)
+            ticket = self.send_template(template, values, priority=(jog_type == JOG_STOP),
+                                        tag=('jog', axis))
+        self.fail_tickets(dropped, error)
+        return ticket
 
     def load_tool_table(self):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            return self.send_command_msg(MT_EMC_TOOL_LOAD_TOOL_TABLE)
+            return self.send_template(command_template(MT_EMC_TOOL_LOAD_TOOL_TABLE))
 
+    # returns None when the setpoint channel defers the value
     def set_maximum_velocity(self, velocity):
         if not self.connected:
             return None
+        velocity = float(velocity)  # a deferred value is encoded by the socket worker
+        if self.defer_setpoint(('maximum_velocity', ), self.send_maximum_velocity, (velocity, )):
+            return None
 
-        with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.velocity = velocity
+        return self.send_maximum_velocity(velocity)
 
-            return self.send_command_msg(MT_EMC_TRAJ_SET_MAX_VELOCITY)
+    def send_maximum_velocity(self, velocity):
+        with self.tx_lock:
+            template = command_template(MT_EMC_TRAJ_SET_MAX_VELOCITY, 'emc_command_params.velocity')
+            return self.send_template(template, (velocity, ))
 
     def set_mist_enabled(self, enable):
         if not self.connected:
@@ -877,120 +1409,102 @@ class ApplicationCommand():
 
         with self.tx_lock:
             if enable:
-                return self.send_command_msg(MT_EMC_COOLANT_MIST_ON)
+                return self.send_template(command_template(MT_EMC_COOLANT_MIST_ON))
             else:
-                return self.send_command_msg(MT_EMC_COOLANT_MIST_OFF)
+                return self.send_template(command_template(MT_EMC_COOLANT_MIST_OFF))
 
     def override_limits(self):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            return self.send_command_msg(MT_EMC_AXIS_OVERRIDE_LIMITS)
+            return self.send_template(command_template(MT_EMC_AXIS_OVERRIDE_LIMITS))
 
     def set_adaptive_feed_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_MOTION_ADAPTIVE)
+            template = command_template(MT_EMC_MOTION_ADAPTIVE, 'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_analog_output(self, index, value):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = index
-            params.value = value
-
-            return self.send_command_msg(MT_EMC_MOTION_SET_AOUT)
+            template = command_template(MT_EMC_MOTION_SET_AOUT,
+                                        'emc_command_params.index', 'emc_command_params.value')
+            return self.send_template(template, (index, value))
 
     def set_block_delete_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_SET_BLOCK_DELETE)
+            template = command_template(MT_EMC_TASK_PLAN_SET_BLOCK_DELETE,
+                                        'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_digital_output(self, index, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = index
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_MOTION_SET_DOUT)
+            template = command_template(MT_EMC_MOTION_SET_DOUT,
+                                        'emc_command_params.index', 'emc_command_params.enable')
+            return self.send_template(template, (index, enable))
 
     def set_feed_hold_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TRAJ_SET_FH_ENABLE)
+            template = command_template(MT_EMC_TRAJ_SET_FH_ENABLE, 'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_feed_override_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TRAJ_SET_FO_ENABLE)
+            template = command_template(MT_EMC_TRAJ_SET_FO_ENABLE, 'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_axis_max_position_limit(self, axis, value):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = axis
-            params.value = value
-
-            return self.send_command_msg(MT_EMC_AXIS_SET_MAX_POSITION_LIMIT)
+            template = command_template(MT_EMC_AXIS_SET_MAX_POSITION_LIMIT,
+                                        'emc_command_params.index', 'emc_command_params.value')
+            return self.send_template(template, (axis, value))
 
     def set_axis_min_position_limit(self, axis, value):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = axis
-            params.value = value
-
-            self.send_command_msg(MT_EMC_AXIS_SET_MIN_POSITION_LIMIT)
+            template = command_template(MT_EMC_AXIS_SET_MIN_POSITION_LIMIT,
+                                        'emc_command_params.index', 'emc_command_params.value')
+            return self.send_template(template, (axis, value))
 
     def set_optional_stop_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TASK_PLAN_SET_OPTIONAL_STOP)
+            template = command_template(MT_EMC_TASK_PLAN_SET_OPTIONAL_STOP,
+                                        'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_spindle_override_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TRAJ_SET_SO_ENABLE)
+            template = command_template(MT_EMC_TRAJ_SET_SO_ENABLE, 'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
     def set_spindle(self, mode, velocity=0.0):
         if not self.connected:
@@ -1019,41 +1533,43 @@ class ApplicationCommand():
 
             return self.send_command_msg(mode_type)
 
+    # returns None when the setpoint channel defers the value
     def set_spindle_override(self, scale):
         if not self.connected:
             return None
+        scale = float(scale)  # a deferred value is encoded by the socket worker
+        if self.defer_setpoint(('spindle_override', ), self.send_spindle_override, (scale, )):
+            return None
 
-        with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.scale = scale
+        return self.send_spindle_override(scale)
 
-            return self.send_command_msg(MT_EMC_TRAJ_SET_SPINDLE_SCALE)
+    def send_spindle_override(self, scale):
+        with self.tx_lock:
+            template = command_template(MT_EMC_TRAJ_SET_SPINDLE_SCALE, 'emc_command_params.scale')
+            return self.send_template(template, (scale, ))
 
     def set_teleop_enabled(self, enable):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.enable = enable
-
-            return self.send_command_msg(MT_EMC_TRAJ_SET_TELEOP_ENABLE)
+            template = command_template(MT_EMC_TRAJ_SET_TELEOP_ENABLE, 'emc_command_params.enable')
+            return self.send_template(template, (enable, ))
 
+    # returns None when the setpoint channel defers the value
     def set_teleop_vector(self, a, b, c, u, v, w):
         if not self.connected:
             return None
+        a, b, c, u, v, w = [float(x) for x in (a, b, c, u, v, w)]  # encoded by the socket worker
+        if self.defer_setpoint(('teleop_vector', ), self.send_teleop_vector, (a, b, c, u, v, w)):
+            return None
 
-        with self.tx_lock:
-            params = self.tx.emc_command_params
-            pose = params.pose
-            pose.a = a
-            pose.b = b
-            pose.c = c
-            pose.u = u
-            pose.v = v
-            pose.w = w
+        return self.send_teleop_vector(a, b, c, u, v, w)
 
-            return self.send_command_msg(MT_EMC_TRAJ_SET_TELEOP_VECTOR)
+    def send_teleop_vector(self, a, b, c, u, v, w):
+        with self.tx_lock:
+            template = command_template(MT_EMC_TRAJ_SET_TELEOP_VECTOR, *TELEOP_VECTOR_PATHS)
+            return self.send_template(template, (b'', a, b, c, u, v, w))
 
     def set_tool_offset(self, index, zoffset, xoffset, diameter, frontangle, backangle, orientation):
         if not self.connected:
@@ -1077,27 +1593,171 @@ class ApplicationCommand():
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.traj_mode = mode
-
-            return self.send_command_msg(MT_EMC_TRAJ_SET_MODE)
+            template = command_template(MT_EMC_TRAJ_SET_MODE, 'emc_command_params.traj_mode')
+            return self.send_template(template, (mode, ))
 
     def unhome_axis(self, index):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            params = self.tx.emc_command_params
-            params.index = index
-
-            return self.send_command_msg(MT_EMC_AXIS_UNHOME)
+            template = command_template(MT_EMC_AXIS_UNHOME, 'emc_command_params.index')
+            return self.send_template(template, (index, ))
 
     def shutdown(self):
         if not self.connected:
             return None
 
         with self.tx_lock:
-            return self.send_command_msg(MT_SHUTDOWN)
+            return self.send_template(command_template(MT_SHUTDOWN))
+
+
+class MdiStream():
+    """Streams MDI lines through an ApplicationCommand, keeping up to window
+    lines in flight instead of waiting for each line to complete."""
+    def __init__(self, command, window=8, interpreter='execute', release='completed'):
+        self.command = command
+        self.window = window
+        self.interpreter = interpreter
+        self.release = release  # 'executed' or 'completed' frees a window slot
+        self.timeout = None  # seconds without progress before the stream fails
+        self.condition = threading.Condition(threading.Lock())
+        self.stop_event = threading.Event()
+
+        # callbacks, called with (line number, latency) from the command worker
+        self.on_line_completed = []
+        # callbacks, called with (line number, error) for every failed line
+        self.on_line_failed = []
+
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_window = 0
+        self.outstanding = 0
+        self.error = None
+        self.error_line = None
+        self.latencies = []
+        self.duration = 0.0
+        self.progress_time = time.time()
+        self.stop_event.clear()
+
+    # sends all lines, returns True when every line completed
+    def run(self, lines):
+        self.reset()
+        start_time = time.time()
+        for line in lines:
+            if not self.wait_window():
+                break
+            try:
+                ticket = self.command.execute_mdi(line, self.interpreter)
+            except RemoteError as e:  # no free slot in time or dropped by an abort
+                self.fail(e, self.sent)
+                break
+            future = None
+            if ticket is not None:
+                future = self.command.command_future(ticket)
+            if future is None:
+                self.fail(RemoteError('command channel not connected'), self.sent)
+                break
+            sent_time = time.time()
+            with self.condition:
+                self.in_window += 1
+                self.outstanding += 1
+                self.sent += 1
+                self.progress_time = sent_time
+            self.track(future, self.sent - 1, sent_time)
+        self.wait_outstanding()
+        self.duration = time.time() - start_time
+        return self.error is None and self.completed == self.sent and not self.stop_event.is_set()
+
+    # stops feeding lines, abort also aborts the interpreter
+    def stop(self, abort=False):
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+        if abort:
+            self.command.abort(self.interpreter)
+
+    def track(self, future, number, sent_time):
+        def slot_done(f):
+            with self.condition:
+                self.in_window -= 1
+                self.progress_time = time.time()
+                self.condition.notify_all()
+
+        def line_done(f):
+            if f.error is not None:
+                self.fail(f.error, number)
+            else:
+                latency = time.time() - sent_time
+                with self.condition:
+                    self.completed += 1
+                    self.latencies.append(latency)
+                for func in self.on_line_completed:
+                    func(number, latency)
+            with self.condition:
+                self.outstanding -= 1
+                self.progress_time = time.time()
+                self.condition.notify_all()
+
+        if self.release == 'executed':
+            future.executed.add_done_callback(slot_done)
+        else:
+            future.add_done_callback(slot_done)
+        future.add_done_callback(line_done)
+
+    def fail(self, error, number):
+        with self.condition:
+            self.failed += 1
+            if self.error is None:  # keep the first error
+                self.error = error
+                self.error_line = number
+            self.condition.notify_all()
+        for func in self.on_line_failed:
+            func(number, error)
+
+    def wait_window(self):
+        with self.condition:
+            while self.in_window >= self.window and self.error is None \
+                    and not self.stop_event.is_set():
+                if not self.wait_progress():
+                    return False
+            return self.error is None and not self.stop_event.is_set()
+
+    def wait_outstanding(self):
+        with self.condition:
+            while self.outstanding > 0:
+                if not self.wait_progress():
+                    return False
+            return True
+
+    # called with the condition held
+    def wait_progress(self):
+        self.condition.wait(timeout=self.timeout)
+        if self.timeout is not None and time.time() - self.progress_time >= self.timeout:
+            if self.error is None:
+                self.error = RemoteTimeout('no progress within %s s' % self.timeout)
+                self.error_line = self.completed
+            return False
+        return True
+
+    def statistics(self):
+        with self.condition:
+            latencies = sorted(self.latencies)
+            completed = self.completed
+            failed = self.failed
+        stats = {'sent': self.sent, 'completed': completed, 'failed': failed, 'duration': self.duration,
+                 'lines_per_second': 0.0, 'error': self.error, 'error_line': self.error_line}
+        if self.duration > 0.0:
+            stats['lines_per_second'] = completed / self.duration
+        for name, fraction in (('latency_p50', 0.5), ('latency_p90', 0.9), ('latency_max', 1.0)):
+            stats[name] = 0.0
+            if latencies:
+                stats[name] = latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+        return stats
 
 
 class ApplicationError():
@@ -1106,12 +1766,13 @@ class ApplicationError():
         self.threads = []
         self.shutdown = threading.Event()
         self.message_lock = threading.Lock()
-        self.timer_lock = threading.Lock()
+        self.scheduler = TimerScheduler()  # heartbeat deadlines, serviced by the socket worker
         self.connected_condition = threading.Condition(threading.Lock())
         self.debug = debug
         self.is_ready = False
 
-        # callbacks
+        # callbacks, run by the dispatcher
+        self.dispatcher = default_dispatcher
         self.on_connected_changed = []
 
         self.connected = False
@@ -1122,7 +1783,7 @@ class ApplicationError():
 
         self.error_uri = ''
         self.heartbeat_period = 0
-        self.heartbeat_timer = None
+        self.heartbeat_timer = HeartbeatTimer(self.scheduler, self.heartbeat_timer_tick)
         self.subscriptions = set()
 
         # more efficient to reuse protobuf message
@@ -1140,13 +1801,17 @@ class ApplicationError():
         poll.register(self.socket, zmq.POLLIN)
 
         while not self.shutdown.is_set():
-            s = dict(poll.poll(200))
+            s = dict(poll.poll(self.scheduler.timeout()))
             if self.socket in s:
                 self.process_error()
+            self.scheduler.run()
 
     def process_error(self):
-        (topic, msg) = self.socket.recv_multipart()
-        self.rx.ParseFromString(msg)
+        (topic, msg) = self.socket.recv_multipart(copy=False)
+        topic = topic.bytes
+        if topic not in self.subscriptions:  # unsubscribed meanwhile, skip parsing
+            return
+        self.rx.ParseFromString(msg.buffer)  # parse from the frame without a copy
 
         if self.debug:
             print('[error] received message: %s' % topic)
@@ -1203,32 +1868,17 @@ class ApplicationError():
         self.update_state('Timeout')
 
     def start_error_heartbeat(self, interval):
-        self.timer_lock.acquire()
-        if self.heartbeat_timer:
-            self.heartbeat_timer.cancel()
-
         self.heartbeat_period = interval
         if interval > 0:
-            self.heartbeat_timer = threading.Timer(interval / 1000,
-                                               self.heartbeat_timer_tick)
-            self.heartbeat_timer.start()
-        self.timer_lock.release()
+            self.heartbeat_timer.start(interval)
+        else:
+            self.heartbeat_timer.stop()
 
     def refresh_error_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.heartbeat_timer:
-            self.heartbeat_timer.cancel()
-            self.heartbeat_timer = threading.Timer(self.heartbeat_period / 1000,
-                                                   self.heartbeat_timer_tick)
-            self.heartbeat_timer.start()
-        self.timer_lock.release()
+        self.heartbeat_timer.refresh()  # only moves the deadline
 
     def stop_error_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.heartbeat_timer:
-            self.heartbeat_timer.cancel()
-            self.heartbeat_timer = None
-        self.timer_lock.release()
+        self.heartbeat_timer.stop()
 
     def update_state(self, state):
         if state != self.state:
@@ -1238,16 +1888,14 @@ class ApplicationError():
                     self.connected = True
                     self.connected_condition.notify()
                 print('[error] connected')
-                for func in self.on_connected_changed:
-                    func(True)
+                self.dispatcher.dispatch(self.on_connected_changed, (True, ), (self, 'connected'))
             elif self.connected:
                 with self.connected_condition:
                     self.connected = False
                     self.connected_condition.notify()
                 self.stop_error_heartbeat()
                 print('[error] disconnected')
-                for func in self.on_connected_changed:
-                    func(False)
+                self.dispatcher.dispatch(self.on_connected_changed, (False, ), (self, 'connected'))
 
     def subscribe(self):
         self.socket_state = 'Trying'
@@ -1,3 +1,16 @@
+import os
+import threading
+import time
+import heapq
+import struct
+import traceback
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # array views are not available
+
+POSITION_AXES = ['x', 'y', 'z', 'a', 'b', 'c', 'u', 'v', 'w']
 
 
 class MessageObject():
@@ -7,55 +20,68 @@ class MessageObject():
 
     def __str__(self):
         output = ''
-        for attr in dir(self)[3:]:
+        for number in sorted(self.id_map):
+            attr = self.id_map[number]
             output += '%s: %s\n' % (attr, getattr(self, attr))
         return output
 
     def __getitem__(self, index):
         if self.is_position:
-            mapping = ['x', 'y', 'z', 'a', 'b', 'c', 'u', 'v', 'w']
-            return getattr(self, mapping[index])
+            return getattr(self, POSITION_AXES[index])
         else:
             raise RuntimeError("Object does not support indexed access")
 
 
+def scalar_default(field):
+    if field.type == field.TYPE_BOOL:
+        return False
+    elif field.type == field.TYPE_DOUBLE \
+    or field.type == field.TYPE_FLOAT:
+        return 0.0
+    elif field.type == field.TYPE_INT32 \
+    or field.type == field.TYPE_INT64 \
+    or field.type == field.TYPE_UINT32 \
+    or field.type == field.TYPE_UINT64:
+        return 0
+    elif field.type == field.TYPE_STRING:
+        return ''
+    elif field.type == field.TYPE_ENUM:
+        return 0
+    return None
+
+
 def recurse_descriptor(descriptor, obj):
-    for field in descriptor.fields:
-        value = None
-
-        if field.type == field.TYPE_BOOL:
-            value = False
-        elif field.type == field.TYPE_DOUBLE \
-        or field.type == field.TYPE_FLOAT:
-            value = 0.0
-        elif field.type == field.TYPE_INT32 \
-        or field.type == field.TYPE_INT64 \
-        or field.type == field.TYPE_UINT32 \
-        or field.type == field.TYPE_UINT64:
-            value = 0
-        elif field.type == field.TYPE_STRING:
-            value = ''
-        elif field.type == field.TYPE_ENUM:
-            value = 0
-        elif field.type == field.TYPE_MESSAGE:
+    plan = get_decode_plan(descriptor)  # schema metadata is computed only once
+    for number, name, kind, sub_plan, value_name, value_default, array_name in plan.steps:
+        if kind == FIELD_SCALAR:
+            value = value_default
+        elif kind == FIELD_REPEATED_VALUE:
+            value = [value_default]
+        else:
             value = MessageObject()
-            msg_descriptor = field.message_type
-            if msg_descriptor.name == 'Position':
-                value.is_position = True
-            recurse_descriptor(msg_descriptor, value)
+            value.is_position = sub_plan.object_class.is_position
+            recurse_descriptor(sub_plan.descriptor, value)
+            if kind == FIELD_REPEATED_MESSAGE:
+                delattr(value, 'index')
+                value = [value]
+
+        setattr(obj, name, value)
+        obj.id_map[number] = name
 
-        if field.label == field.LABEL_REPEATED:
-            delattr(value, 'index')
-            attributes = dir(value)
-            if len(attributes) == 4:  # only single attribute
-                value = getattr(value, attributes[-1])
-            value = [value]
 
-        setattr(obj, field.name, value)
-        obj.id_map[field.number] = field.name
+# changed field paths are appended to changes if it is not None,
+# e.g. motion.position.x or io.tool_table[3].diameter for prefix 'motion'/'io'
+def recurse_message(message, obj, field_filter='', changes=None, prefix=''):
+    if use_decode_plans and field_filter == '':
+        apply_decode_plan(get_decode_plan(message.DESCRIPTOR), message, obj,
+                          changes, prefix)
+    else:
+        walk_message(message, obj, field_filter)
+        if changes is not None:
+            changes.append(prefix)  # the walker does not track single fields
 
 
-def recurse_message(message, obj, field_filter=''):
+def walk_message(message, obj, field_filter=''):
     for descriptor in message.DESCRIPTOR.fields:
         filter_enabled = field_filter != ''
         # TODO: handle special file case here...
@@ -72,7 +98,7 @@ def recurse_message(message, obj, field_filter=''):
             if message.HasField(name):
                 if descriptor.type == descriptor.TYPE_MESSAGE:
                     sub_obj = getattr(obj, name)
-                    recurse_message(getattr(message, name), sub_obj)
+                    walk_message(getattr(message, name), sub_obj)
                 else:
                     setattr(obj, name, getattr(message, name))
         else:
@@ -86,14 +112,905 @@ def recurse_message(message, obj, field_filter=''):
                         array.append(MessageObject())
 
                     value = None
-                    if len(sub_message.DESCRIPTOR.fields) == 2:
-                        sub_obj = MessageObject()
-                        recurse_descriptor(sub_message.DESCRIPTOR, sub_obj)
-                        recurse_message(sub_message, sub_obj)
-                        delattr(sub_obj, 'index')
-                        value = getattr(sub_obj, dir(sub_obj)[-1])
+                    value_name = get_decode_plan(sub_message.DESCRIPTOR).value_name
+                    if value_name is not None:
+                        value = getattr(sub_message, value_name)
                     else:
                         sub_obj = array[index]
-                        recurse_message(sub_message, sub_obj)
+                        walk_message(sub_message, sub_obj)
                         value = sub_obj
                     array[index] = value
+
+
+# decode plans compile the field walk of recurse_message once per message
+# type, set to False to fall back to the descriptor walker
+use_decode_plans = True
+
+FIELD_SCALAR = 0
+FIELD_MESSAGE = 1
+FIELD_REPEATED_MESSAGE = 2
+FIELD_REPEATED_VALUE = 3  # repeated message carrying only index and value
+
+_decode_plans = {}
+_compiling_plans = {}
+_decode_plans_lock = threading.RLock()
+
+
+class StatusObject(object):
+    """Base of the __slots__ classes generated per message type,
+    attribute layout and defaults are stored on the generated class."""
+    __slots__ = ()
+    id_map = {}
+    is_position = False
+    field_defaults = ()  # (name, kind, default value or plan)
+    array_names = ()  # slots for NumPy views, None until attached
+
+    def __init__(self):
+        for name in self.array_names:
+            setattr(self, name, None)
+        for name, kind, default in self.field_defaults:
+            if kind == FIELD_SCALAR:
+                setattr(self, name, default)
+            elif kind == FIELD_MESSAGE:
+                setattr(self, name, default.new_object())
+            elif kind == FIELD_REPEATED_MESSAGE:
+                setattr(self, name, [default.new_object()])
+            else:
+                setattr(self, name, [default])
+
+    def __str__(self):
+        output = ''
+        for attr in self.__slots__:
+            output += '%s: %s\n' % (attr, getattr(self, attr))
+        return output
+
+    def __getitem__(self, index):
+        if self.is_position:
+            return getattr(self, POSITION_AXES[index])
+        else:
+            raise RuntimeError("Object does not support indexed access")
+
+
+class DecodePlan():
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.object_class = None
+        self.prototype = None  # default instance, cloned by new_object
+        self.value_name = None  # set when the message only wraps an indexed value
+        self.steps = []  # (number, name, kind, sub plan, value name, default, array name)
+        self.steps_by_number = {}
+        self.is_position = descriptor.name == 'Position'
+        self.table_dtype = None  # NumPy dtype of a row for messages with numeric fields
+
+        # schema metadata grouped by field kind
+        self.scalar_names = []
+        self.scalar_defaults = []
+        self.message_fields = []
+        self.repeated_message_fields = []
+        self.repeated_value_names = []
+        self.repeated_value_defaults = []
+        self.position_arrays = []  # (array name, field name)
+        self.table_arrays = []  # (array name, field name, sub plan)
+
+    def compile(self):
+        fields = self.descriptor.fields
+        if len(fields) == 2 and 'index' in [f.name for f in fields]:
+            self.value_name = [f.name for f in fields if f.name != 'index'][0]
+
+        for field in fields:
+            kind = FIELD_SCALAR
+            sub_plan = None
+            value_name = None
+            value_default = scalar_default(field)
+            array_name = None
+
+            if field.type == field.TYPE_MESSAGE:
+                sub_plan = get_decode_plan(field.message_type)
+                kind = FIELD_MESSAGE
+
+            if field.label == field.LABEL_REPEATED:
+                if sub_plan is None:
+                    continue  # repeated scalars are not part of the object model
+                if sub_plan.value_name is not None:
+                    kind = FIELD_REPEATED_VALUE
+                    value_name = sub_plan.value_name
+                    value_field = field.message_type.fields_by_name[value_name]
+                    value_default = scalar_default(value_field)
+                else:
+                    kind = FIELD_REPEATED_MESSAGE
+
+            if numpy is not None:
+                if kind == FIELD_MESSAGE and sub_plan.is_position:
+                    array_name = '%s_array' % field.name
+                    self.position_arrays.append((array_name, field.name))
+                elif kind == FIELD_REPEATED_MESSAGE and sub_plan.table_dtype is not None:
+                    array_name = '%s_array' % field.name
+                    self.table_arrays.append((array_name, field.name, sub_plan))
+
+            step = (field.number, field.name, kind, sub_plan, value_name, value_default,
+                    array_name)
+            self.steps.append(step)
+            self.steps_by_number[field.number] = step
+
+            if kind == FIELD_SCALAR:
+                self.scalar_names.append(field.name)
+                self.scalar_defaults.append((field.name, value_default))
+            elif kind == FIELD_MESSAGE:
+                self.message_fields.append((field.name, sub_plan))
+            elif kind == FIELD_REPEATED_MESSAGE:
+                self.repeated_message_fields.append((field.name, sub_plan))
+            else:
+                self.repeated_value_names.append(field.name)
+                self.repeated_value_defaults.append((field.name, value_default))
+
+        if numpy is not None:
+            self.table_dtype = self.compile_table_dtype()
+        self.object_class = self.generate_class()
+        self.prototype = self.object_class()
+
+    def compile_table_dtype(self):
+        types = []
+        for field in self.descriptor.fields:
+            if field.name == 'index':
+                continue  # the row number
+            if field.label == field.LABEL_REPEATED:
+                return None
+            if field.type == field.TYPE_BOOL:
+                types.append((str(field.name), numpy.bool_))
+            elif field.type == field.TYPE_DOUBLE \
+            or field.type == field.TYPE_FLOAT:
+                types.append((str(field.name), numpy.float64))
+            elif field.type == field.TYPE_INT32 \
+            or field.type == field.TYPE_ENUM:
+                types.append((str(field.name), numpy.int32))
+            elif field.type == field.TYPE_UINT32:
+                types.append((str(field.name), numpy.uint32))
+            elif field.type == field.TYPE_INT64:
+                types.append((str(field.name), numpy.int64))
+            elif field.type == field.TYPE_UINT64:
+                types.append((str(field.name), numpy.uint64))
+            else:
+                return None  # only plain numeric messages are stored as table
+        if len(types) == 0:
+            return None
+        return numpy.dtype(types)
+
+    def generate_class(self):
+        names = []
+        id_map = {}
+        field_defaults = []
+        for number, name, kind, sub_plan, value_name, value_default, array_name in self.steps:
+            names.append(name)
+            id_map[number] = name
+            if kind == FIELD_SCALAR or kind == FIELD_REPEATED_VALUE:
+                field_defaults.append((name, kind, value_default))
+            else:
+                field_defaults.append((name, kind, sub_plan))
+
+        array_names = [array_name for array_name, _ in self.position_arrays]
+        array_names += [array_name for array_name, _, _ in self.table_arrays]
+
+        attributes = {'__slots__': tuple(names + array_names),
+                      'id_map': id_map,
+                      'is_position': self.is_position,
+                      'field_defaults': tuple(field_defaults),
+                      'array_names': tuple(array_names)}
+        return type(str(self.descriptor.name), (StatusObject,), attributes)
+
+    def new_object(self):
+        return self.clone(self.prototype)
+
+    def copy(self, obj):
+        new_obj = self.object_class.__new__(self.object_class)
+        for name in self.object_class.__slots__:
+            setattr(new_obj, name, getattr(obj, name))
+        return new_obj
+
+    def clone(self, obj):
+        new_obj = self.object_class.__new__(self.object_class)
+        for name in self.scalar_names:
+            setattr(new_obj, name, getattr(obj, name))
+        for name, sub_plan in self.message_fields:
+            setattr(new_obj, name, sub_plan.clone(getattr(obj, name)))
+        for name, sub_plan in self.repeated_message_fields:
+            setattr(new_obj, name, [sub_plan.clone(item) for item in getattr(obj, name)])
+        for name in self.repeated_value_names:
+            setattr(new_obj, name, list(getattr(obj, name)))
+        for name in self.object_class.array_names:
+            array = getattr(obj, name)
+            if array is not None:
+                array = readonly_view(array.copy())
+            setattr(new_obj, name, array)
+        return new_obj
+
+    def reset_object(self, obj):
+        for name, default in self.scalar_defaults:
+            setattr(obj, name, default)
+        for name, sub_plan in self.message_fields:
+            sub_plan.reset_object(getattr(obj, name))
+        for name, sub_plan in self.repeated_message_fields:
+            array = getattr(obj, name)
+            if len(array) > 0:
+                del array[1:]
+                sub_plan.reset_object(array[0])
+            else:
+                array.append(sub_plan.new_object())
+        for name, default in self.repeated_value_defaults:
+            getattr(obj, name)[:] = [default]
+        if self.object_class.array_names and self.arrays_attached(obj):
+            self.attach_arrays(obj)
+
+    def arrays_attached(self, obj):
+        return getattr(obj, obj.array_names[0]) is not None
+
+    # creates the NumPy views of position and per-axis data for obj
+    def attach_arrays(self, obj):
+        if numpy is None:
+            raise RuntimeError('NumPy is required for array views')
+        for array_name, name in self.position_arrays:
+            setattr(obj, array_name, position_array(getattr(obj, name)))
+        for array_name, name, sub_plan in self.table_arrays:
+            setattr(obj, array_name, table_array(sub_plan, getattr(obj, name)))
+
+
+def readonly_view(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def position_array(position):
+    return readonly_view(numpy.array([getattr(position, axis) for axis in POSITION_AXES],
+                                     dtype=numpy.float64))
+
+
+def table_row(sub_plan, item):
+    return tuple(getattr(item, name) for name in sub_plan.table_dtype.names)
+
+
+def table_array(sub_plan, items):
+    array = numpy.zeros(len(items), dtype=sub_plan.table_dtype)
+    for index, item in enumerate(items):
+        array[index] = table_row(sub_plan, item)
+    return readonly_view(array)
+
+
+# updates the rows of a table view in place, returns a new view when it had to grow
+def update_table_array(sub_plan, view, items, indices):
+    if len(view) < len(items):
+        return table_array(sub_plan, items)
+    array = view.base
+    for index in indices:
+        array[index] = table_row(sub_plan, items[index])
+    return view
+
+
+def get_decode_plan(descriptor):
+    key = descriptor.full_name
+    plan = _decode_plans.get(key)
+    if plan is not None:
+        return plan
+
+    with _decode_plans_lock:
+        plan = _decode_plans.get(key) or _compiling_plans.get(key)
+        if plan is None:
+            plan = DecodePlan(descriptor)
+            _compiling_plans[key] = plan  # nested types may refer back
+            plan.compile()
+            del _compiling_plans[key]
+            _decode_plans[key] = plan
+        return plan
+
+
+def apply_decode_plan(plan, message, obj, changes=None, prefix=''):
+    steps = plan.steps_by_number
+    for field, value in message.ListFields():  # only fields present on the wire
+        step = steps.get(field.number)
+        if step is None:
+            continue  # we do not know the field
+        number, name, kind, sub_plan, value_name, value_default, array_name = step
+
+        if kind == FIELD_SCALAR:
+            if changes is not None and getattr(obj, name) != value:
+                changes.append('%s.%s' % (prefix, name))
+            setattr(obj, name, value)
+        elif kind == FIELD_MESSAGE:
+            sub_prefix = None
+            if changes is not None:
+                sub_prefix = '%s.%s' % (prefix, name)
+            sub_obj = getattr(obj, name)
+            apply_decode_plan(sub_plan, value, sub_obj, changes, sub_prefix)
+            if array_name is not None and getattr(obj, array_name) is not None:
+                getattr(obj, array_name).base[:] = [getattr(sub_obj, axis) for axis in POSITION_AXES]
+        else:
+            array = getattr(obj, name)
+            for sub_message in value:
+                index = sub_message.index
+                if changes is not None and len(array) < (index + 1):
+                    changes.append('%s.%s' % (prefix, name))
+                if kind == FIELD_REPEATED_VALUE:
+                    while len(array) < (index + 1):
+                        array.append(value_default)
+                    item = getattr(sub_message, value_name)
+                    if changes is not None and array[index] != item:
+                        changes.append('%s.%s[%i]' % (prefix, name, index))
+                    array[index] = item
+                else:
+                    while len(array) < (index + 1):
+                        array.append(sub_plan.new_object())
+                    sub_prefix = None
+                    if changes is not None:
+                        sub_prefix = '%s.%s[%i]' % (prefix, name, index)
+                    apply_decode_plan(sub_plan, sub_message, array[index], changes, sub_prefix)
+            if array_name is not None and getattr(obj, array_name) is not None:
+                indices = [sub_message.index for sub_message in value]
+                setattr(obj, array_name,
+                        update_table_array(sub_plan, getattr(obj, array_name), array, indices))
+
+
+def recurse_message_copy(message, obj, changes=None, prefix=''):
+    return apply_decode_plan_copy(get_decode_plan(message.DESCRIPTOR), message, obj,
+                                  changes, prefix)
+
+
+def apply_decode_plan_copy(plan, message, obj, changes=None, prefix=''):
+    """Returns an updated copy of obj and leaves obj untouched, sub-objects
+    and arrays without changes are shared with the previous version."""
+    new_obj = plan.copy(obj)
+    steps = plan.steps_by_number
+    for field, value in message.ListFields():
+        step = steps.get(field.number)
+        if step is None:
+            continue  # we do not know the field
+        number, name, kind, sub_plan, value_name, value_default, array_name = step
+
+        if kind == FIELD_SCALAR:
+            if changes is not None and getattr(obj, name) != value:
+                changes.append('%s.%s' % (prefix, name))
+            setattr(new_obj, name, value)
+        elif kind == FIELD_MESSAGE:
+            sub_prefix = None
+            if changes is not None:
+                sub_prefix = '%s.%s' % (prefix, name)
+            sub_obj = apply_decode_plan_copy(sub_plan, value, getattr(obj, name),
+                                             changes, sub_prefix)
+            setattr(new_obj, name, sub_obj)
+            if array_name is not None and getattr(obj, array_name) is not None:
+                setattr(new_obj, array_name, position_array(sub_obj))
+        else:
+            array = list(getattr(obj, name))
+            for sub_message in value:
+                index = sub_message.index
+                if changes is not None and len(array) < (index + 1):
+                    changes.append('%s.%s' % (prefix, name))
+                if kind == FIELD_REPEATED_VALUE:
+                    while len(array) < (index + 1):
+                        array.append(value_default)
+                    item = getattr(sub_message, value_name)
+                    if changes is not None and array[index] != item:
+                        changes.append('%s.%s[%i]' % (prefix, name, index))
+                    array[index] = item
+                else:
+                    while len(array) < (index + 1):
+                        array.append(sub_plan.prototype)
+                    sub_prefix = None
+                    if changes is not None:
+                        sub_prefix = '%s.%s[%i]' % (prefix, name, index)
+                    array[index] = apply_decode_plan_copy(sub_plan, sub_message, array[index],
+                                                          changes, sub_prefix)
+            setattr(new_obj, name, array)
+            if array_name is not None and getattr(obj, array_name) is not None:
+                view = readonly_view(getattr(obj, array_name).copy())  # never modify published data
+                indices = [sub_message.index for sub_message in value]
+                setattr(new_obj, array_name, update_table_array(sub_plan, view, array, indices))
+    return new_obj
+
+
+def parse_path(path):
+    """Splits a field path like io.tool_table[3].diameter into attribute
+    names and indices."""
+    elements = []
+    for part in path.split('.'):
+        while '[' in part:
+            name, rest = part.split('[', 1)
+            index, part = rest.split(']', 1)
+            if name != '':
+                elements.append(name)
+            elements.append(int(index))
+        if part != '':
+            elements.append(part)
+    return elements
+
+
+def resolve_path(obj, elements):
+    for element in elements:
+        if isinstance(element, int):
+            obj = obj[element]
+        else:
+            obj = getattr(obj, element)
+    return obj
+
+
+def path_affected(path, changed_path):
+    """True if a change at changed_path may modify the value at path."""
+    if path == changed_path:
+        return True
+    if path.startswith(changed_path):  # parent changed
+        return path[len(changed_path)] in '.['
+    if changed_path.startswith(path):  # child changed
+        return changed_path[len(path)] in '.['
+    return False
+
+
+# returns a function reading CLOCK_MONOTONIC through ctypes, None if the
+# C library does not provide clock_gettime
+def clock_gettime_monotonic():
+    try:
+        import ctypes
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for library in ('librt.so.1', 'libc.so.6'):  # glibc before 2.17 has it in librt
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+        byref = ctypes.byref
+
+        def monotonic():
+            ts = timespec()  # per call, the clock is read from many threads
+            if clock_gettime(1, byref(ts)) != 0:  # CLOCK_MONOTONIC
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return None
+
+
+# monotonic clock for deadlines, an NTP step must not fire or delay
+# heartbeat timeouts, the wall clock is only the last resort
+monotonic = getattr(time, 'monotonic', None) or clock_gettime_monotonic() or time.time
+
+
+class TimerScheduler():
+    """Keeps timer deadlines in a heap, serviced by the socket worker."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []  # (deadline, sequence, generation, timer)
+        self.sequence = 0
+
+    def schedule(self, timer, deadline, generation):
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.heap, (deadline, self.sequence, generation, timer))
+
+    # returns the poll timeout in ms until the next deadline
+    def timeout(self, maximum=200):
+        with self.lock:
+            if len(self.heap) == 0:
+                return maximum
+            remaining = (self.heap[0][0] - monotonic()) * 1000
+        return min(maximum, max(0, int(remaining) + 1))
+
+    # fires all expired timers, must be called from the socket worker
+    def run(self):
+        expired = []
+        with self.lock:
+            now = monotonic()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                deadline, _, generation, timer = heapq.heappop(self.heap)
+                if generation != timer.generation or timer.deadline is None:
+                    continue  # restarted or stopped meanwhile
+                if timer.deadline > deadline:  # refreshed, check again later
+                    self.sequence += 1
+                    heapq.heappush(self.heap, (timer.deadline, self.sequence, generation, timer))
+                    continue
+                timer.deadline = None
+                expired.append(timer)
+        for timer in expired:
+            timer.callback()
+
+
+class HeartbeatTimer():
+    """One shot timer of a TimerScheduler, a refresh only stores a new deadline."""
+    def __init__(self, scheduler, callback):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.period = 0.0
+        self.deadline = None  # None when not running
+        self.generation = 0
+
+    @property
+    def active(self):
+        return self.deadline is not None
+
+    # starts or restarts the timer, period in ms
+    def start(self, period):
+        self.period = period / 1000.0
+        self.generation += 1
+        self.deadline = monotonic() + self.period
+        self.scheduler.schedule(self, self.deadline, self.generation)
+
+    def refresh(self):
+        if self.deadline is not None:
+            self.deadline = monotonic() + self.period
+
+    def stop(self):
+        self.deadline = None
+
+
+DISPATCH_INLINE = 'inline'  # callbacks run on the thread causing the change
+DISPATCH_THREAD = 'thread'  # callbacks run on a dedicated dispatch thread
+DISPATCH_POOL = 'pool'  # callbacks run on a pool of dispatch threads
+
+
+class CallbackDispatcher():
+    """Runs user callbacks inline or out of band on dispatch threads.
+
+    Queued callbacks with the same key are coalesced, only the latest
+    arguments are delivered. Callbacks with the same key never run
+    concurrently and keep their order."""
+    def __init__(self, mode=DISPATCH_INLINE, workers=4, slow_threshold=0.05,
+                 idle_timeout=1.0):
+        self.mode = mode
+        self.workers = workers  # number of threads in pool mode
+        self.slow_threshold = slow_threshold  # s, callbacks taking longer are reported to on_slow_callback
+        self.idle_timeout = idle_timeout  # s, idle dispatch threads exit
+        self.condition = threading.Condition(threading.Lock())
+        self.queue = []  # keys in dispatch order
+        self.pending = {}  # (callbacks, args) by key
+        self.running = set()  # keys currently executed
+        self.threads = []
+
+        # callbacks, called with the slow callback and its duration in s,
+        # callbacks are only timed while a handler is registered
+        self.on_slow_callback = []
+
+    def dispatch(self, callbacks, args=(), key=None):
+        if len(callbacks) == 0:
+            return
+        if self.mode == DISPATCH_INLINE:
+            self.run(callbacks, args)
+            return
+
+        with self.condition:
+            if key is None:
+                key = object()  # not coalesced
+            if key not in self.pending:
+                self.queue.append(key)
+            self.pending[key] = (tuple(callbacks), args)  # latest arguments win
+            threads = 1
+            if self.mode == DISPATCH_POOL:
+                threads = max(1, self.workers)
+            if len(self.threads) < min(threads, len(self.queue)):
+                thread = threading.Thread(target=self.dispatch_worker)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+
+    def run(self, callbacks, args):
+        if len(self.on_slow_callback) == 0:
+            for func in callbacks:
+                func(*args)
+            return
+        for func in callbacks:
+            start = monotonic()
+            func(*args)
+            duration = monotonic() - start
+            if duration > self.slow_threshold:
+                self.report_slow_callback(func, duration)
+
+    def report_slow_callback(self, func, duration):
+        for handler in self.on_slow_callback:
+            handler(func, duration)
+
+    def next_key(self):
+        for i, key in enumerate(self.queue):
+            if key not in self.running:
+                del self.queue[i]
+                return key
+        return None
+
+    def dispatch_worker(self):
+        while True:
+            with self.condition:
+                key = self.next_key()
+                if key is None:
+                    self.condition.wait(self.idle_timeout)
+                    key = self.next_key()
+                    if key is None:
+                        self.threads.remove(threading.current_thread())
+                        return
+                callbacks, args = self.pending.pop(key)
+                self.running.add(key)
+            try:
+                self.run(callbacks, args)
+            except Exception:
+                print('[dispatch] exception in callback')
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.running.discard(key)
+                    self.condition.notify_all()
+
+    # waits until all queued callbacks have been executed
+    def flush(self, timeout=None):
+        if timeout is not None:
+            end_time = monotonic() + timeout
+        with self.condition:
+            while len(self.queue) > 0 or len(self.running) > 0:
+                if timeout is None:
+                    self.condition.wait(0.1)
+                else:
+                    remaining = end_time - monotonic()
+                    if remaining <= 0.0:
+                        return False
+                    self.condition.wait(remaining)
+        return True
+
+
+# used by all clients unless a dispatcher is assigned to them
+default_dispatcher = CallbackDispatcher()
+
+
+class RemoteError(Exception):
+    """The remote side rejected an operation or the connection was lost."""
+
+
+class RemoteTimeout(RemoteError):
+    """No confirmation of an operation arrived in time."""
+
+
+class Future():
+    """Result of a remote operation, resolved by the socket worker."""
+    def __init__(self, condition=None):
+        if condition is None:  # related futures may share one condition
+            condition = threading.Condition(threading.Lock())
+        self.condition = condition
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self, value):
+        return self.resolve(value, None)
+
+    def set_exception(self, error):
+        return self.resolve(None, error)
+
+    def resolve(self, value, error):
+        with self.condition:
+            if self.finished:
+                return False  # only the first outcome counts
+            self.finished = True
+            self.value = value
+            self.error = error
+            self.condition.notify_all()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for func in callbacks:
+            func(self)
+        return True
+
+    # func(future) is called once the future is done, from the resolving thread
+    def add_done_callback(self, func):
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def wait(self, timeout=None):
+        with self.condition:
+            if timeout is None:
+                while not self.finished:
+                    self.condition.wait()
+                return True
+            end_time = monotonic() + timeout
+            while not self.finished:
+                remaining = end_time - monotonic()
+                if remaining <= 0.0:
+                    break
+                self.condition.wait(timeout=remaining)
+            return self.finished
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RemoteTimeout('no result within %s s' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise RemoteTimeout('no result within %s s' % timeout)
+        return self.error
+
+
+# waits until all futures are done, returns False on timeout
+def wait_futures(futures, timeout=None):
+    if timeout is not None:
+        end_time = monotonic() + timeout
+    for future in futures:
+        remaining = None
+        if timeout is not None:
+            remaining = max(0.0, end_time - monotonic())
+        if not future.wait(remaining):
+            return False
+    return True
+
+
+# hand encoding of messages sent at a high rate, the constant part of a
+# message is serialized once and the varying fields are appended as bytes
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+_small_varints = [bytes(bytearray([value])) for value in range(0x80)]
+
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64  # negative integers take ten bytes
+    if value < 0x80:
+        return _small_varints[value]
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def field_tag(field, wire_type):
+    return encode_varint((field.number << 3) | wire_type)
+
+
+_fixed_formats = {}
+_varint_ranges = {}
+
+
+# returns func(value) that converts the value to an int and raises
+# ValueError like a protobuf message would for values it cannot hold
+def varint_checker(field):
+    if not _varint_ranges:
+        _varint_ranges.update({
+            field.TYPE_INT32: (-(1 << 31), (1 << 31) - 1),
+            field.TYPE_SINT32: (-(1 << 31), (1 << 31) - 1),
+            field.TYPE_UINT32: (0, (1 << 32) - 1),
+            field.TYPE_INT64: (-(1 << 63), (1 << 63) - 1),
+            field.TYPE_SINT64: (-(1 << 63), (1 << 63) - 1),
+            field.TYPE_UINT64: (0, (1 << 64) - 1),
+        })
+
+    if field.type == field.TYPE_ENUM:
+        numbers = frozenset(field.enum_type.values_by_number)
+
+        def check_enum(value):
+            value = int(value)
+            if value not in numbers:
+                raise ValueError('Unknown enum value: %d' % value)
+            return value
+        return check_enum
+
+    minimum, maximum = _varint_ranges[field.type]
+
+    def check_range(value):
+        value = int(value)
+        if not minimum <= value <= maximum:
+            raise ValueError('Value out of range: %d' % value)
+        return value
+    return check_range
+
+
+# returns func(value) that encodes the field including its tag, message
+# fields take the encoded submessage as value
+def field_encoder(field):
+    if not _fixed_formats:
+        _fixed_formats.update({
+            field.TYPE_DOUBLE: (WIRE_FIXED64, struct.Struct('<d').pack),
+            field.TYPE_FLOAT: (WIRE_FIXED32, struct.Struct('<f').pack),
+            field.TYPE_FIXED64: (WIRE_FIXED64, struct.Struct('<Q').pack),
+            field.TYPE_SFIXED64: (WIRE_FIXED64, struct.Struct('<q').pack),
+            field.TYPE_FIXED32: (WIRE_FIXED32, struct.Struct('<I').pack),
+            field.TYPE_SFIXED32: (WIRE_FIXED32, struct.Struct('<i').pack),
+        })
+
+    if field.type in _fixed_formats:
+        wire_type, pack = _fixed_formats[field.type]
+        tag = field_tag(field, wire_type)
+
+        def encode_fixed(value):
+            try:
+                return tag + pack(value)
+            except struct.error:
+                raise ValueError('Value out of range: %r' % (value, ))
+        return encode_fixed
+    elif field.type == field.TYPE_BOOL:
+        tag = field_tag(field, WIRE_VARINT)
+        encoded = (tag + b'\x00', tag + b'\x01')
+        return lambda value: encoded[bool(value)]
+    elif field.type in (field.TYPE_INT32, field.TYPE_INT64, field.TYPE_UINT32,
+                        field.TYPE_UINT64, field.TYPE_ENUM):
+        tag = field_tag(field, WIRE_VARINT)
+        check = varint_checker(field)
+        return lambda value: tag + encode_varint(check(value))
+    elif field.type in (field.TYPE_SINT32, field.TYPE_SINT64):
+        tag = field_tag(field, WIRE_VARINT)
+        check = varint_checker(field)
+
+        def encode_zigzag(value):
+            value = check(value)
+            return tag + encode_varint((value << 1) ^ (value >> 63))
+        return encode_zigzag
+    elif field.type in (field.TYPE_STRING, field.TYPE_BYTES, field.TYPE_MESSAGE):
+        tag = field_tag(field, WIRE_LENGTH)
+
+        def encode_length(value):
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            return tag + encode_varint(len(value)) + value
+        return encode_length
+    raise ValueError('cannot encode field %s' % field.full_name)
+
+
+class EncodePlan():
+    """Encodes the fields named by paths in the order of the values,
+    fields of nested messages are named by dotted paths, e.g.
+    'emc_command_params.velocity'."""
+    def __init__(self, descriptor, paths):
+        self.descriptor = descriptor
+        self.paths = tuple(paths)
+        self.steps = []  # (encoder, value index, sub plan, value indices)
+
+        nested = {}
+        for index, path in enumerate(self.paths):
+            name, _, rest = path.partition('.')
+            field = descriptor.fields_by_name[name]
+            if not rest:
+                self.steps.append((field_encoder(field), index, None, None))
+                continue
+            if name not in nested:
+                nested[name] = ([], [])
+                self.steps.append((field_encoder(field), None, name, nested[name][1]))
+            nested[name][0].append(rest)
+            nested[name][1].append(index)
+
+        for i, (encoder, index, name, indices) in enumerate(self.steps):
+            if name is not None:
+                field = descriptor.fields_by_name[name]
+                sub_plan = EncodePlan(field.message_type, nested[name][0])
+                self.steps[i] = (encoder, index, sub_plan, tuple(indices))
+
+    def encode(self, values):
+        data = []
+        for encoder, index, sub_plan, indices in self.steps:
+            if sub_plan is None:
+                data.append(encoder(values[index]))
+            else:
+                data.append(encoder(sub_plan.encode([values[i] for i in indices])))
+        return b''.join(data)
+
+
+class MessageTemplate():
+    """Message with constant fields serialized once, the fields named by
+    paths are encoded by hand behind them for every message."""
+    def __init__(self, message, paths=()):
+        self.message = message
+        self.prefix = message.SerializeToString()
+        self.plan = EncodePlan(message.DESCRIPTOR, paths)
+
+    def encode(self, values=()):
+        if not values:
+            return self.prefix
+        return self.prefix + self.plan.encode(values)
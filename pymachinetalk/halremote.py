@@ -1,15 +1,89 @@
 import uuid
 import platform
+import time
+import array
+import operator
+import collections
 
 import zmq
 import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # array reads and writes are not available
+
 # protobuf
 from machinetalk.protobuf.message_pb2 import Container
 from machinetalk.protobuf.types_pb2 import *
-
-
-class Pin():
+from common import TimerScheduler, HeartbeatTimer, default_dispatcher, monotonic
+from common import Future, RemoteError, RemoteTimeout, wait_futures
+from common import EncodePlan, MessageTemplate, field_encoder, field_tag, encode_varint, WIRE_LENGTH
+
+# array type codes and NumPy dtypes of the pin store
+PIN_TYPECODES = {HAL_FLOAT: 'd', HAL_BIT: 'B', HAL_S32: 'i', HAL_U32: 'I'}
+PIN_DTYPES = {HAL_FLOAT: 'float64', HAL_BIT: 'bool', HAL_S32: 'int32', HAL_U32: 'uint32'}
+
+# protobuf value field, Python type and value accessor of each HAL type
+PIN_VALUE_FIELDS = {HAL_FLOAT: 'halfloat', HAL_BIT: 'halbit', HAL_S32: 'hals32', HAL_U32: 'halu32'}
+PIN_VALUE_TYPES = {HAL_FLOAT: float, HAL_BIT: bool, HAL_S32: int, HAL_U32: int}
+PIN_VALUE_GETTERS = dict((pintype, operator.attrgetter(field))
+                         for pintype, field in PIN_VALUE_FIELDS.items())
+
+# pre-encoded halrcmd messages, a set message is followed by one encoded pin per change
+ping_message = MessageTemplate(Container(type=MT_PING)).encode()
+set_message = MessageTemplate(Container(type=MT_HALRCOMP_SET)).encode()
+PIN_FIELD = Container.DESCRIPTOR.fields_by_name['pin']
+PIN_TAG = field_tag(PIN_FIELD, WIRE_LENGTH)
+PIN_HEADER_PLAN = EncodePlan(PIN_FIELD.message_type, ('handle', 'type'))
+PIN_VALUE_ENCODERS = dict((pintype, field_encoder(PIN_FIELD.message_type.fields_by_name[field]))
+                          for pintype, field in PIN_VALUE_FIELDS.items())
+
+
+def send_wakeup(socket):
+    try:
+        socket.send(b'', zmq.NOBLOCK)
+    except zmq.Again:
+        pass  # the worker has not read the earlier wakeups yet
+
+
+def drain_wakeups(socket):
+    while True:
+        try:
+            socket.recv(zmq.NOBLOCK)
+        except zmq.Again:
+            break
+
+
+# runs the socket operations queued by other threads, on the socket worker
+def run_socket_calls(calls, name):
+    while calls:
+        func, args = calls.popleft()
+        try:
+            func(*args)
+        except zmq.ZMQError as e:
+            print('[%s] error: %s' % (name, e))
+
+
+# converts the value to the Python type of the pin, raises ValueError or
+# TypeError if the value cannot be encoded
+def check_pin_value(pintype, value):
+    value = PIN_VALUE_TYPES[pintype](value)
+    PIN_VALUE_ENCODERS[pintype](value)
+    return value
+
+
+# headers caches the encoded handle and type fields by (handle, type)
+def encode_pin(headers, pintype, handle, value):
+    header = headers.get((handle, pintype))
+    if header is None:
+        header = PIN_HEADER_PLAN.encode((handle, pintype))
+        headers[(handle, pintype)] = header
+    value = PIN_VALUE_ENCODERS[pintype](value)
+    return PIN_TAG + encode_varint(len(header) + len(value)) + header + value
+
+
+class Pin(object):
     def __init__(self):
         self.name = ''
         self.pintype = HAL_BIT
@@ -18,6 +92,8 @@ class Pin():
         self._value = None
         self.handle = 0  # stores handle received on bind
         self.parent = None
+        self.max_update_rate = None  # Hz, None uses the rate of the component
+        self.last_sent = 0.0
         self.synced_condition = threading.Condition(threading.Lock())
         self.value_condition = threading.Condition(threading.Lock())
 
@@ -47,11 +123,11 @@ class Pin():
     @value.setter
     def value(self, value):
         with self.value_condition:
-            if self._value != value:
-                self._value = value
-                self.value_condition.notify()
-                for func in self.on_value_changed:
-                    func(value)
+            if self._value == value:
+                return
+            self._value = value
+            self.value_condition.notify()
+        self.dispatch(self.on_value_changed, value, 'value')  # outside of the lock
 
     @property
     def synced(self):
@@ -61,40 +137,306 @@ class Pin():
     @synced.setter
     def synced(self, value):
         with self.synced_condition:
-            if value != self._synced:
-                self._synced = value
-                self.synced_condition.notify()
-                for func in self.on_synced_changed:
-                    func(value)
+            if value == self._synced:
+                return
+            self._synced = value
+            self.synced_condition.notify()
+        self.dispatch(self.on_synced_changed, value, 'synced')
+
+    def dispatch(self, callbacks, value, kind):
+        if len(callbacks) == 0:
+            return
+        dispatcher = default_dispatcher
+        if self.parent:
+            dispatcher = self.parent.dispatcher
+        dispatcher.dispatch(callbacks, (value, ), (self, kind))
+
+    # returns a future resolved with the value echoed by haltalk if future is set
+    def set(self, value, future=False, timeout=None):
+        write = None
+        if future and self.parent is None:
+            write = Future()
+            write.set_exception(RemoteError('%s is not part of a component' % self.name))
+        elif future:
+            write = self.parent.write_future(self, value, timeout)
+        if self.value != value:
+            self.value = value
+            self.synced = False
+            if self.parent:
+                self.parent.pin_change(self)
+        return write
+
+    def set_and_wait(self, value, timeout=None):
+        return self.set(value, future=True, timeout=timeout).result()
+
+    def get(self):
+        return self.value
+
+
+class PinStore():
+    """Keeps the values of many pins in typed arrays grouped by HAL type."""
+    def __init__(self, owner=None):
+        self.owner = owner  # component providing the callback dispatcher
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.values = {}  # typed value array by HAL type
+        self.synced = {}  # synced flags by HAL type
+        self.pins = {}  # pin proxies by HAL type, in array order
+        self.handles = {}  # (pintype, index) by handle
+        self.value_callbacks = {}  # only pins with callbacks have entries
+        self.synced_callbacks = {}
+        for pintype, typecode in PIN_TYPECODES.items():
+            self.values[pintype] = array.array(typecode)
+            self.synced[pintype] = bytearray()
+            self.pins[pintype] = []
+
+    def add(self, pin):
+        with self.lock:
+            values = self.values[pin.pintype]
+            values.append(0)
+            self.synced[pin.pintype].append(0)
+            self.pins[pin.pintype].append(pin)
+            return len(values) - 1
+
+    def get_value(self, pintype, index):
+        with self.lock:
+            value = self.values[pintype][index]
+        if pintype == HAL_BIT:
+            return bool(value)
+        return value
+
+    def set_value(self, pintype, index, value):
+        if pintype != HAL_FLOAT:
+            value = int(value)  # integer arrays do not accept floats
+        with self.condition:
+            values = self.values[pintype]
+            if values[index] == value:
+                return
+            values[index] = value
+            self.condition.notify_all()
+            callbacks = self.value_callbacks.get((pintype, index))
+        if callbacks:
+            self.dispatch(callbacks, self.get_value(pintype, index), (pintype, index, 'value'))
+
+    def get_synced(self, pintype, index):
+        with self.lock:
+            return bool(self.synced[pintype][index])
+
+    def set_synced(self, pintype, index, value):
+        with self.condition:
+            synced = self.synced[pintype]
+            if synced[index] == value:
+                return
+            synced[index] = value
+            self.condition.notify_all()
+            callbacks = self.synced_callbacks.get((pintype, index))
+        if callbacks:
+            self.dispatch(callbacks, value, (pintype, index, 'synced'))
+
+    def unsync(self):
+        for pintype, synced in self.synced.items():
+            for index in range(len(synced)):
+                self.set_synced(pintype, index, False)
+
+    def apply_updates(self, rpins):
+        # updates many pins with a single lock acquisition, the pin type
+        # is known from the handle so no field probing is required
+        changed = []
+        with self.condition:
+            for rpin in rpins:
+                entry = self.handles.get(rpin.handle)
+                if entry is None:  # unknown until the full update after a bind
+                    continue
+                pintype, index = entry
+                value = PIN_VALUE_GETTERS[pintype](rpin)
+                values = self.values[pintype]
+                if values[index] != value:
+                    values[index] = value
+                    if (pintype, index) in self.value_callbacks:
+                        changed.append((pintype, index, value))
+                synced = self.synced[pintype]
+                if not synced[index]:
+                    synced[index] = 1
+                    if (pintype, index) in self.synced_callbacks:
+                        changed.append((pintype, index, None))
+            self.condition.notify_all()
+        for pintype, index, value in changed:
+            if value is None:
+                self.dispatch(self.synced_callbacks[(pintype, index)], True,
+                              (pintype, index, 'synced'))
+            else:
+                if pintype == HAL_BIT:
+                    value = bool(value)
+                self.dispatch(self.value_callbacks[(pintype, index)], value,
+                              (pintype, index, 'value'))
+
+    def dispatch(self, callbacks, value, kind):
+        dispatcher = default_dispatcher
+        if self.owner is not None:
+            dispatcher = self.owner.dispatcher
+        dispatcher.dispatch(callbacks, (value, ), (self, ) + kind)
+
+    def read_array(self, pintype):
+        if numpy is None:
+            raise RuntimeError('NumPy is required for array access')
+        with self.lock:
+            values = self.values[pintype]
+            if len(values) == 0:
+                return numpy.zeros(0, dtype=PIN_DTYPES[pintype])
+            data = numpy.frombuffer(values, dtype=values.typecode).copy()
+        return data.astype(PIN_DTYPES[pintype], copy=False)
+
+
+class CompactPin(object):
+    """Lightweight pin proxy, the state is held by the pin store."""
+    __slots__ = ('name', 'pintype', 'direction', 'index', '_handle', 'store',
+                 'parent', 'max_update_rate', 'last_sent')
+
+    def __init__(self, store, name, pintype, direction):
+        self.name = name
+        self.pintype = pintype
+        self.direction = direction
+        self._handle = 0
+        self.store = store
+        self.parent = None
+        self.max_update_rate = None  # Hz, None uses the rate of the component
+        self.last_sent = 0.0
+        self.index = store.add(self)
+
+    @property
+    def handle(self):
+        return self._handle
+
+    @handle.setter
+    def handle(self, value):
+        store = self.store
+        key = (self.pintype, self.index)
+        with store.lock:
+            if store.handles.get(self._handle) == key:  # another pin may own it after a rebind
+                del store.handles[self._handle]
+            store.handles[value] = key
+        self._handle = value
+
+    @property
+    def on_value_changed(self):
+        return self.store.value_callbacks.setdefault((self.pintype, self.index), [])
+
+    @property
+    def on_synced_changed(self):
+        return self.store.synced_callbacks.setdefault((self.pintype, self.index), [])
+
+    def wait_synced(self, timeout=None):
+        with self.store.condition:
+            if self.store.synced[self.pintype][self.index]:
+                return True
+            self.store.condition.wait(timeout=timeout)
+        return self.synced
+
+    def wait_value(self, timeout=None):
+        with self.store.condition:
+            if self.store.values[self.pintype][self.index]:
+                return True
+            self.store.condition.wait(timeout=timeout)
+        return self.value
+
+    @property
+    def value(self):
+        return self.store.get_value(self.pintype, self.index)
 
-    def set(self, value):
+    @value.setter
+    def value(self, value):
+        self.store.set_value(self.pintype, self.index, value)
+
+    @property
+    def synced(self):
+        return self.store.get_synced(self.pintype, self.index)
+
+    @synced.setter
+    def synced(self, value):
+        self.store.set_synced(self.pintype, self.index, value)
+
+    # returns a future resolved with the value echoed by haltalk if future is set
+    def set(self, value, future=False, timeout=None):
+        write = None
+        if future and self.parent is None:
+            write = Future()
+            write.set_exception(RemoteError('%s is not part of a component' % self.name))
+        elif future:
+            write = self.parent.write_future(self, value, timeout)
         if self.value != value:
             self.value = value
             self.synced = False
             if self.parent:
                 self.parent.pin_change(self)
+        return write
+
+    def set_and_wait(self, value, timeout=None):
+        return self.set(value, future=True, timeout=timeout).result()
 
     def get(self):
         return self.value
 
 
+class PinBatch():
+    """Collects pin changes and sends them in a single message on exit."""
+    def __init__(self, component):
+        self.component = component
+
+    def __enter__(self):
+        with self.component.batch_lock:
+            self.component.batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        comp = self.component
+        with comp.batch_lock:
+            comp.batch_depth -= 1
+            if comp.batch_depth > 0:
+                return False  # nested batch, the outermost one sends
+            pins = list(comp.batch_pins.values())
+            comp.batch_pins = {}
+        if len(pins) > 0:
+            comp.send_pin_changes(pins)
+        return False
+
+
 class RemoteComponent():
-    def __init__(self, name, debug=False):
+    def __init__(self, name, debug=False, compact=False, session=None):
         self.threads = []
         self.shutdown = threading.Event()
         self.tx_lock = threading.Lock()
-        self.timer_lock = threading.Lock()
+        self.batch_lock = threading.Lock()
         self.connected_condition = threading.Condition(threading.Lock())
         self.debug = debug
 
-        # callbacks
+        # callbacks, run by the dispatcher, also for the pins
+        self.dispatcher = default_dispatcher
         self.on_connected_changed = []
 
         self.name = name
         self.pinsbyname = {}
         self.pinsbyhandle = {}
+        self.handles_stale = False  # set by a bind, the next full update learns the handles
+        self.pin_headers = {}  # encoded pin headers, dropped with the handles on a bind
+        self.pinsbyfullname = {}  # by name including the component prefix
+        self.pin_order = []  # pin names in creation order, the order of snapshot arrays
+        self.update_lock = threading.RLock()  # held while a message updates the pins
+        self.write_lock = threading.Lock()
+        self.pending_writes = {}  # list of (value, future, deadline, timeout) by pin name, oldest first
+        self.write_timeout = 5.0  # s, default timeout of write futures
+        self.bind_cache = None  # bind message, rebuilt when the pin set changes
+        self.pin_store = None
+        if compact:
+            self.pin_store = PinStore(self)  # pin values in typed arrays
         self.is_ready = False
         self.no_create = False
+        self.batch_depth = 0
+        self.batch_pins = {}  # changed pins by name while a batch is open
+        self.max_update_rate = 0.0  # Hz, 0 sends every pin change immediately
+        self.rate_lock = threading.Lock()
+        self.rate_limited_pins = {}  # pins waiting for their send window by name
+        self.socket_calls = collections.deque()  # (func, args) of other threads, run by the worker
+        self.wakeup_lock = threading.Lock()
 
         self.halrcmd_uri = ''
         self.halrcomp_uri = ''
@@ -105,14 +447,25 @@ class RemoteComponent():
         self.halrcmd_state = 'Down'
         self.halrcomp_state = 'Down'
         self.halrcomp_period = 0
-        self.halrcmd_timer = None
-        self.halrcomp_timer = None
+        if session is not None:
+            self.scheduler = session.scheduler  # serviced by the session worker
+        else:
+            self.scheduler = TimerScheduler()  # heartbeat deadlines, serviced by the socket worker
+        self.halrcmd_timer = HeartbeatTimer(self.scheduler, self.halrcmd_timer_tick)
+        self.halrcomp_timer = HeartbeatTimer(self.scheduler, self.halrcomp_timer_tick)
+        self.write_timer = HeartbeatTimer(self.scheduler, self.expire_writes)  # earliest write deadline
 
         # more efficient to reuse a protobuf message
         self.tx = Container()
         self.rx = Container()
+        self.tx_buffer = bytearray()  # encoded set messages
 
         # ZeroMQ
+        self.session = None
+        self.sockets_connected = False
+        if session is not None:
+            session.add(self)  # sockets are shared with the session
+            return
         client_id = '%s-%s' % (platform.node(), uuid.uuid4())  # must be unique
         context = zmq.Context()
         context.linger = 0
@@ -121,7 +474,12 @@ class RemoteComponent():
         self.halrcmd_socket.setsockopt(zmq.LINGER, 0)
         self.halrcmd_socket.setsockopt(zmq.IDENTITY, client_id)
         self.halrcomp_socket = self.context.socket(zmq.SUB)
-        self.sockets_connected = False
+        # wakes the socket worker for queued socket calls and deferred pins
+        wakeup_uri = 'inproc://halrcomp-wakeup-%s' % uuid.uuid4()
+        self.wakeup_receiver = self.context.socket(zmq.PAIR)
+        self.wakeup_receiver.bind(wakeup_uri)
+        self.wakeup_sender = self.context.socket(zmq.PAIR)
+        self.wakeup_sender.connect(wakeup_uri)
 
     def wait_connected(self, timeout=None):
         with self.connected_condition:
@@ -134,79 +492,149 @@ class RemoteComponent():
         poll = zmq.Poller()
         poll.register(self.halrcmd_socket, zmq.POLLIN)
         poll.register(self.halrcomp_socket, zmq.POLLIN)
+        poll.register(self.wakeup_receiver, zmq.POLLIN)
 
         while not self.shutdown.is_set():
-            s = dict(poll.poll(200))
+            s = dict(poll.poll(self.poll_timeout()))
             if self.halrcmd_socket in s:
                 self.process_halrcmd()
             if self.halrcomp_socket in s:
                 self.process_halrcomp()
+            if self.wakeup_receiver in s:
+                drain_wakeups(self.wakeup_receiver)
+            if self.socket_calls:
+                run_socket_calls(self.socket_calls, self.name)
+            if self.rate_limited_pins:
+                self.flush_rate_limited_pins()
+            self.scheduler.run()
+
+    # e.g. the poll timeout was computed before the pin was deferred
+    def wake_worker(self):
+        if self.session is not None:
+            self.session.wake_worker()
+        elif self.threads and threading.current_thread() not in self.threads:
+            with self.wakeup_lock:
+                send_wakeup(self.wakeup_sender)
+
+    # ZeroMQ sockets must only be used by the socket worker, other threads
+    # queue func(*args) and wake the worker up
+    def socket_call(self, func, *args):
+        if self.session is not None:
+            self.session.socket_call(func, *args)
+        elif self.threads and threading.current_thread() not in self.threads:
+            self.socket_calls.append((func, args))
+            self.wake_worker()
+        else:
+            func(*args)
+
+    def poll_timeout(self):
+        timeout = self.scheduler.timeout()
+        with self.rate_lock:
+            if self.rate_limited_pins:
+                now = time.time()
+                for pin in self.rate_limited_pins.values():
+                    remaining = (self.next_send_time(pin) - now) * 1000
+                    timeout = min(timeout, max(0, int(remaining) + 1))
+        return timeout
 
     def process_halrcmd(self):
         msg = self.halrcmd_socket.recv()
         self.rx.ParseFromString(msg)
+        self.halrcmd_message(self.rx)
+
+    # handles a halrcmd reply, also called by the session
+    def halrcmd_message(self, rx):
         if self.debug:
             print('[%s] received message on halrcmd:' % self.name)
-            print(self.rx)
+            print(rx)
 
-        if self.rx.type == MT_PING_ACKNOWLEDGE:
+        if rx.type == MT_PING_ACKNOWLEDGE:
             self.ping_outstanding = False
             if self.halrcmd_state == 'Trying':
                 self.update_state('Connecting')
                 self.bind()
 
-        elif self.rx.type == MT_HALRCOMP_BIND_CONFIRM:
+        elif rx.type == MT_HALRCOMP_BIND_CONFIRM:
             self.halrcmd_state = 'Up'
+            self.handles_stale = True  # the old map is used until the full update
+            self.pin_headers = {}
             self.unsubscribe()  # clear previous subscription
             self.subscribe()  # trigger full update
 
-        elif self.rx.type == MT_HALRCOMP_BIND_REJECT \
-        or self.rx.type == MT_HALRCOMP_SET_REJECT:
+        elif rx.type == MT_HALRCOMP_BIND_REJECT \
+        or rx.type == MT_HALRCOMP_SET_REJECT:
+            if rx.type == MT_HALRCOMP_SET_REJECT:
+                self.fail_writes(RemoteError('set rejected: %s' % ', '.join(rx.note)),
+                                 [rpin.handle for rpin in rx.pin])
             self.halrcmd_state = 'Down'
             self.update_state('Error')
-            if self.rx.type == MT_HALRCOMP_BIND_REJECT:
-                self.update_error('Bind', self.rx.note)
+            if rx.type == MT_HALRCOMP_BIND_REJECT:
+                self.update_error('Bind', rx.note)
             else:
-                self.update_error('Pinchange', self.rx.note)
+                self.update_error('Pinchange', rx.note)
 
         else:
             print('[%s] Warning: halrcmd receiced unsupported message' % self.name)
 
     def process_halrcomp(self):
-        (topic, msg) = self.halrcomp_socket.recv_multipart()
-        self.rx.ParseFromString(msg)
-
-        if topic != self.name:  # ignore uninteresting messages
+        (topic, msg) = self.halrcomp_socket.recv_multipart(copy=False)
+        topic = topic.bytes
+        if topic != self.name:  # ignore uninteresting messages before parsing
             return
 
+        self.rx.ParseFromString(msg.buffer)  # parse from the frame without a copy
+        self.halrcomp_message(topic, self.rx)
+
+    # handles a halrcomp update for this component, also called by the session
+    def halrcomp_message(self, topic, rx):
         if self.debug:
             print('[%s] received message on halrcomp: topic %s' % (self.name, topic))
-            print(self.rx)
-
-        if self.rx.type == MT_HALRCOMP_INCREMENTAL_UPDATE:
-            for rpin in self.rx.pin:
-                lpin = self.pinsbyhandle[rpin.handle]
-                self.pin_update(rpin, lpin)
-                self.refresh_halrcomp_heartbeat()
+            print(rx)
 
-        elif self.rx.type == MT_HALRCOMP_FULL_UPDATE:
-            comp = self.rx.comp[0]
+        if rx.type == MT_HALRCOMP_INCREMENTAL_UPDATE:
+            if self.pin_store is not None:
+                self.pin_store.apply_updates(rx.pin)
+            else:
+                with self.update_lock:
+                    for rpin in rx.pin:
+                        lpin = self.pinsbyhandle.get(rpin.handle)
+                        if lpin is not None:  # unknown until the full update after a bind
+                            self.pin_update(rpin, lpin)
+            if self.pending_writes:
+                self.confirm_writes(rx.pin)
+            self.refresh_halrcomp_heartbeat()
+
+        elif rx.type == MT_HALRCOMP_FULL_UPDATE:
+            comp = rx.comp[0]
+            pinsbyhandle = self.pinsbyhandle
+            if self.handles_stale:  # haltalk may have reassigned the handles
+                pinsbyhandle = {}
             for rpin in comp.pin:
-                name = rpin.name.split('.')[1]
-                lpin = self.pinsbyname[name]
-                lpin.handle = rpin.handle
-                self.pinsbyhandle[rpin.handle] = lpin
-                self.pin_update(rpin, lpin)
+                handle = rpin.handle
+                if handle not in pinsbyhandle:  # only names after a bind are looked up
+                    lpin = self.pinsbyfullname[rpin.name]
+                    lpin.handle = handle
+                    pinsbyhandle[handle] = lpin
+            self.pinsbyhandle = pinsbyhandle
+            self.handles_stale = False
+            if self.pin_store is not None:
+                self.pin_store.apply_updates(comp.pin)
+            else:
+                with self.update_lock:
+                    for rpin in comp.pin:
+                        self.pin_update(rpin, pinsbyhandle[rpin.handle])
+            if self.pending_writes:
+                self.confirm_writes(comp.pin)
 
             if self.halrcomp_state != 'Up':  # will be executed only once
                 self.halrcomp_state = 'Up'
                 self.update_state('Connected')
 
-            if self.rx.HasField('pparams'):
-                interval = self.rx.pparams.keepalive_timer
+            if rx.HasField('pparams'):
+                interval = rx.pparams.keepalive_timer
                 self.start_halrcomp_heartbeat(interval * 2)
 
-        elif self.rx.type == MT_PING:
+        elif rx.type == MT_PING:
             if self.halrcomp_state == 'Up':
                 self.refresh_halrcomp_heartbeat()
             else:
@@ -214,15 +642,19 @@ class RemoteComponent():
                 self.unsubscribe()  # clean up previous subscription
                 self.subscribe()  # trigger a fresh subscribe -> full update
 
-        elif self.rx.type == MT_HALRCOMMAND_ERROR:
+        elif rx.type == MT_HALRCOMMAND_ERROR:
             self.halrcomp_state = 'Down'
             self.update_state('Error')
-            self.update_error('halrcomp', self.rx.note)
+            self.update_error('halrcomp', rx.note)
 
     def start(self):
         self.halrcmd_state = 'Trying'
         self.update_state('Connecting')
 
+        if self.session is not None:
+            self.session.start_component(self)
+            return
+
         if self.connect_sockets():
             self.shutdown.clear()  # in case we already used the component
             self.threads.append(threading.Thread(target=self.socket_worker))
@@ -238,7 +670,10 @@ class RemoteComponent():
         for thread in self.threads:
             thread.join()
         self.threads = []
+        run_socket_calls(self.socket_calls, self.name)  # the worker is gone
         self.cleanup()
+        if self.session is not None:
+            self.session.stop_component(self)
         self.update_state('Disconnected')
 
     def cleanup(self):
@@ -261,13 +696,23 @@ class RemoteComponent():
             self.sockets_connected = False
 
     def send_cmd(self, msg_type):
+        if msg_type == MT_PING:
+            self.send_data(msg_type, ping_message)
+            return
         self.tx.type = msg_type
         if self.debug:
             print('[%s] sending message: %s' % (self.name, msg_type))
             print(str(self.tx))
-        self.halrcmd_socket.send(self.tx.SerializeToString(), zmq.NOBLOCK)
+        self.socket_call(self.halrcmd_socket.send, self.tx.SerializeToString(), zmq.NOBLOCK)
         self.tx.Clear()
 
+    # sends an encoded message, copied because buffers are reused
+    def send_data(self, msg_type, data):
+        if self.debug:
+            print('[%s] sending message: %s' % (self.name, msg_type))
+            print(str(Container.FromString(bytes(data))))
+        self.socket_call(self.halrcmd_socket.send, bytes(data), zmq.NOBLOCK)
+
     def halrcmd_timer_tick(self):
         if not self.connected:
             return
@@ -280,9 +725,7 @@ class RemoteComponent():
             self.send_cmd(MT_PING)
         self.ping_outstanding = True
 
-        self.halrcmd_timer = threading.Timer(self.heartbeat_period / 1000,
-                                             self.halrcmd_timer_tick)
-        self.halrcmd_timer.start()  # rearm timer
+        self.halrcmd_timer.start(self.heartbeat_period)  # rearm timer
 
     def start_halrcmd_heartbeat(self):
         if not self.connected:
@@ -291,46 +734,27 @@ class RemoteComponent():
         self.ping_outstanding = False
 
         if self.heartbeat_period > 0:
-            self.halrcmd_timer = threading.Timer(self.heartbeat_period / 1000,
-                                                 self.halrcmd_timer_tick)
-            self.halrcmd_timer.start()
+            self.halrcmd_timer.start(self.heartbeat_period)
 
     def stop_halrcmd_heartbeat(self):
-        if self.halrcmd_timer:
-            self.halrcmd_timer.cancel()
-            self.halrcmd_timer = None
+        self.halrcmd_timer.stop()
 
     def halrcomp_timer_tick(self):
         self.halrcomp_state = 'Down'
         self.update_state('Timeout')
 
     def start_halrcomp_heartbeat(self, interval):
-        self.timer_lock.acquire()
-        if self.halrcomp_timer:
-            self.halrcomp_timer.cancel()
-
         self.halrcomp_period = interval
         if interval > 0:
-            self.halrcomp_timer = threading.Timer(interval / 1000,
-                                                  self.halrcomp_timer_tick)
-            self.halrcomp_timer.start()
-        self.timer_lock.release()
+            self.halrcomp_timer.start(interval)
+        else:
+            self.halrcomp_timer.stop()
 
     def stop_halrcomp_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.halrcomp_timer:
-            self.halrcomp_timer.cancel()
-            self.halrcomp_timer = None
-        self.timer_lock.release()
+        self.halrcomp_timer.stop()
 
     def refresh_halrcomp_heartbeat(self):
-        self.timer_lock.acquire()
-        if self.halrcomp_timer:
-            self.halrcomp_timer.cancel()
-            self.halrcomp_timer = threading.Timer(self.halrcomp_period / 1000,
-                                                  self.halrcomp_timer_tick)
-            self.halrcomp_timer.start()
-        self.timer_lock.release()
+        self.halrcomp_timer.refresh()  # only moves the deadline
 
     def update_state(self, state):
         if state != self.state:
@@ -340,16 +764,15 @@ class RemoteComponent():
                     self.connected = True
                     self.connected_condition.notify()
                 print('[%s] connected' % self.name)
-                for func in self.on_connected_changed:
-                    func(self.connected)
+                self.dispatcher.dispatch(self.on_connected_changed, (self.connected, ), (self, 'connected'))
             elif self.connected:
                 with self.connected_condition:
                     self.connected = False
                     self.connected_condition.notify()
                 self.stop_halrcomp_heartbeat()
+                self.fail_writes(RemoteError('%s disconnected' % self.name))
                 print('[%s] disconnected' % self.name)
-                for func in self.on_connected_changed:
-                    func(self.connected)
+                self.dispatcher.dispatch(self.on_connected_changed, (self.connected, ), (self, 'connected'))
             elif state == 'Error':
                 with self.connected_condition:
                     self.connected = False
@@ -360,26 +783,28 @@ class RemoteComponent():
 
     # create a new HAL pin
     def newpin(self, name, pintype, direction):
-        pin = Pin()
-        pin.name = name
-        pin.pintype = pintype
-        pin.direction = direction
+        if self.pin_store is not None:
+            pin = CompactPin(self.pin_store, name, pintype, direction)  # zero initialized
+        else:
+            pin = Pin()
+            pin.name = name
+            pin.pintype = pintype
+            pin.direction = direction
+            pin.value = PIN_VALUE_TYPES[pintype]()
         pin.parent = self
+        if name not in self.pinsbyname:
+            self.pin_order.append(name)
         self.pinsbyname[name] = pin
-
-        if pintype == HAL_FLOAT:
-            pin.value = 0.0
-        elif pintype == HAL_BIT:
-            pin.value = False
-        elif pintype == HAL_S32:
-            pin.value = 0
-        elif pintype == HAL_U32:
-            pin.value = 0
+        self.pinsbyfullname['%s.%s' % (self.name, name)] = pin
+        self.bind_cache = None  # the pin set changed
 
         return pin
 
     def unsync_pins(self):
-        for pin in self.pinsbyname:
+        if self.pin_store is not None:
+            self.pin_store.unsync()
+            return
+        for pin in self.pinsbyname.values():
             pin.synced = False
 
     def getpin(self, name):
@@ -391,18 +816,9 @@ class RemoteComponent():
             self.start()
 
     def pin_update(self, rpin, lpin):
-        if rpin.HasField('halfloat'):
-            lpin.value = float(rpin.halfloat)
-            lpin.synced = True
-        elif rpin.HasField('halbit'):
-            lpin.value = bool(rpin.halbit)
-            lpin.synced = True
-        elif rpin.HasField('hals32'):
-            lpin.value = int(rpin.hals32)
-            lpin.synced = True
-        elif rpin.HasField('halu32'):
-            lpin.value = int(rpin.halu32)
-            lpin.synced = True
+        # the local pin type selects the value field, no need to probe
+        lpin.value = PIN_VALUE_GETTERS[lpin.pintype](rpin)
+        lpin.synced = True
 
     def pin_change(self, pin):
         if self.debug:
@@ -413,6 +829,58 @@ class RemoteComponent():
         if pin.direction == HAL_IN:  # only update out and IO pins
             return
 
+        rate = self.pin_update_rate(pin)
+        if rate > 0.0:
+            check_pin_value(pin.pintype, pin.value)  # raise here, not on the socket worker
+            with self.rate_lock:
+                now = time.time()
+                if pin.name in self.rate_limited_pins:
+                    self.rate_limited_pins[pin.name] = pin  # the worker already waits for it
+                    return
+                deferred = now < (pin.last_sent + 1.0 / rate)
+                if deferred:
+                    # the latest value is sent by the socket worker
+                    self.rate_limited_pins[pin.name] = pin
+                else:
+                    pin.last_sent = now
+            if deferred:
+                self.wake_worker()  # the send window may open before the poll timeout
+                return
+
+        with self.batch_lock:
+            if self.batch_depth > 0:
+                self.batch_pins[pin.name] = pin  # sent when the batch is closed
+                return
+
+        self.send_pin_changes([pin])
+
+    def pin_update_rate(self, pin):
+        if pin.max_update_rate is not None:
+            return pin.max_update_rate
+        return self.max_update_rate
+
+    def next_send_time(self, pin):
+        rate = self.pin_update_rate(pin)
+        if rate <= 0.0:
+            return 0.0  # rate limit was disabled meanwhile
+        return pin.last_sent + 1.0 / rate
+
+    def flush_rate_limited_pins(self):
+        pins = []
+        with self.rate_lock:
+            now = time.time()
+            for name, pin in list(self.rate_limited_pins.items()):
+                if now >= self.next_send_time(pin):
+                    pin.last_sent = now
+                    pins.append(pin)
+                    del self.rate_limited_pins[name]
+        if len(pins) > 0 and self.state == 'Connected':
+            try:
+                self.send_pin_changes(pins)
+            except (ValueError, TypeError) as e:  # must not stop the socket worker
+                print('[%s] error: pin changes not sent: %s' % (self.name, e))
+
+    def send_pin_changes(self, pins):
         # This message MUST carry a Pin message for each pin which has
         # changed value since the last message of this type.
         # Each Pin message MUST carry the handle field.
@@ -421,48 +889,234 @@ class RemoteComponent():
         # Each Pin message MUST - depending on pin type - carry a halbit,
         # halfloat, hals32, or halu32 field.
         with self.tx_lock:
-            p = self.tx.pin.add()
-            p.handle = pin.handle
-            p.type = pin.pintype
-            if p.type == HAL_FLOAT:
-                p.halfloat = float(pin.value)
-            elif p.type == HAL_BIT:
-                p.halbit = bool(pin.value)
-            elif p.type == HAL_S32:
-                p.hals32 = int(pin.value)
-            elif p.type == HAL_U32:
-                p.halu32 = int(pin.value)
-            self.send_cmd(MT_HALRCOMP_SET)
-
-    def bind(self):
-        with self.tx_lock:
-            c = self.tx.comp.add()
+            data = self.tx_buffer
+            del data[:]
+            data += set_message
+            headers = self.pin_headers
+            for pin in pins:
+                pintype = pin.pintype
+                data += encode_pin(headers, pintype, pin.handle, PIN_VALUE_TYPES[pintype](pin.value))
+            self.send_data(MT_HALRCOMP_SET, data)
+
+    # registers a future resolved when haltalk echoes value for the pin
+    def write_future(self, pin, value, timeout=None):
+        future = Future()
+        value = PIN_VALUE_TYPES[pin.pintype](value)
+        if pin.direction == HAL_IN:
+            future.set_exception(RemoteError('%s is an input pin' % pin.name))
+            return future
+        if self.state != 'Connected':
+            future.set_exception(RemoteError('%s is not connected' % self.name))
+            return future
+        if pin.value == value and pin.synced:
+            future.set_result(value)  # nothing to send
+            return future
+
+        if timeout is None:
+            timeout = self.write_timeout
+        deadline = None
+        if timeout > 0:
+            deadline = monotonic() + timeout
+        with self.write_lock:
+            self.pending_writes.setdefault(pin.name, []).append((value, future, deadline, timeout))
+            timer = self.write_timer
+            if deadline is not None and (not timer.active or deadline < timer.deadline):
+                timer.start(timeout * 1000)  # one timer sweeps all pending writes
+        return future
+
+    def confirm_writes(self, rpins):
+        confirmed = []
+        with self.write_lock:
+            for rpin in rpins:
+                pin = self.pinsbyhandle.get(rpin.handle)
+                if pin is None or pin.name not in self.pending_writes:
+                    continue
+                writes = self.pending_writes[pin.name]
+                value = PIN_VALUE_GETTERS[pin.pintype](rpin)
+                for i in range(len(writes) - 1, -1, -1):
+                    if writes[i][0] == value:  # older writes were superseded
+                        confirmed.extend((value, write[1]) for write in writes[:i + 1])
+                        del writes[:i + 1]
+                        break
+                if len(writes) == 0:
+                    del self.pending_writes[pin.name]
+        for value, future in confirmed:
+            future.set_result(value)
+
+    # fails the writes past their deadline and rearms the timer for the next one
+    def expire_writes(self):
+        expired = []
+        next_deadline = None
+        with self.write_lock:
+            now = monotonic()
+            for name in list(self.pending_writes):
+                writes = self.pending_writes[name]
+                kept = []
+                for write in writes:
+                    deadline = write[2]
+                    if deadline is not None and deadline <= now:
+                        expired.append((name, write[1], write[3]))
+                        continue
+                    kept.append(write)
+                    if deadline is not None and (next_deadline is None or deadline < next_deadline):
+                        next_deadline = deadline
+                if len(kept) == 0:
+                    del self.pending_writes[name]
+                else:
+                    writes[:] = kept
+            timer = self.write_timer
+            if next_deadline is not None and (not timer.active or next_deadline < timer.deadline):
+                timer.start((next_deadline - now) * 1000)
+        for name, future, timeout in expired:
+            future.set_exception(RemoteTimeout('%s not confirmed within %s s' % (name, timeout)))
+
+    # fails the pending writes of the pins with the given handles, or all
+    def fail_writes(self, error, handles=None):
+        failed = []
+        with self.write_lock:
+            names = list(self.pending_writes)
+            if handles:
+                names = [self.pinsbyhandle[handle].name for handle in handles
+                         if handle in self.pinsbyhandle]
+            for name in names:
+                failed.extend(write[1] for write in self.pending_writes.pop(name, []))
+        for future in failed:
+            future.set_exception(error)
+
+    # pin changes inside the with block are sent as one message
+    def batch(self):
+        return PinBatch(self)
+
+    # sets many pins and sends the changes in one message, values is either
+    # a mapping of pin names or a sequence in the order of pin_names(),
+    # either of all pins or of the output pins only, input pins are
+    # skipped in both forms, returns a list of write futures if futures is set
+    def set_many(self, values, futures=False, timeout=None):
+        if hasattr(values, 'items'):
+            items = [(self.pinsbyname[name], value) for name, value in values.items()]
+        else:
+            pins = [self.pinsbyname[name] for name in self.pin_order]
+            outputs = [pin for pin in pins if pin.direction != HAL_IN]
+            if len(values) == len(outputs):
+                pins = outputs
+            elif len(values) != len(pins):
+                raise ValueError('Expected %i or %i values, got %i'
+                                 % (len(pins), len(outputs), len(values)))
+            if hasattr(values, 'tolist'):
+                values = values.tolist()  # convert NumPy scalars
+            items = zip(pins, values)
+        items = [(pin, value) for pin, value in items if pin.direction != HAL_IN]
+        writes = []
+        with self.batch():
+            for pin, value in items:
+                write = pin.set(value, future=futures, timeout=timeout)
+                if write is not None:
+                    writes.append(write)
+        if futures:
+            return writes
+
+    # sets many pins and waits until haltalk confirmed all values,
+    # raises RemoteError or RemoteTimeout
+    def set_and_wait(self, values, timeout=None):
+        writes = self.set_many(values, futures=True, timeout=timeout)
+        if not wait_futures(writes, timeout):
+            raise RemoteTimeout('pin writes not confirmed within %s s' % timeout)
+        for write in writes:
+            write.result()
+
+    # returns the pin names in the order used for arrays
+    def pin_names(self):
+        return list(self.pin_order)
+
+    def read_values(self, pins):
+        store = self.pin_store
+        if store is not None:
+            with store.lock:  # copy the typed arrays, then pick the values
+                arrays = dict((pintype, values.tolist()) for pintype, values in store.values.items())
+            arrays[HAL_BIT] = [bool(value) for value in arrays[HAL_BIT]]
+            return [arrays[pin.pintype][pin.index] for pin in pins]
+        with self.update_lock:  # no message is applied meanwhile
+            return [pin._value for pin in pins]
+
+    # returns the values of the named pins read at once as dict,
+    # or as NumPy float array in the order of names
+    def get_many(self, names, as_array=False):
+        values = self.read_values([self.pinsbyname[name] for name in names])
+        if as_array:
+            if numpy is None:
+                raise RuntimeError('NumPy is required for array access')
+            return numpy.array(values, dtype='float64')
+        return dict(zip(names, values))
+
+    # returns all pin values read at once, arrays are in the order of pin_names()
+    def snapshot(self, as_array=False):
+        return self.get_many(self.pin_order, as_array=as_array)
+
+    # returns the pins of one HAL type in the order of read_array
+    def pins_of_type(self, pintype):
+        if self.pin_store is None:
+            raise RuntimeError('Component was not created with a pin store')
+        return list(self.pin_store.pins[pintype])
+
+    # returns the values of all pins of one HAL type as NumPy array
+    def read_array(self, pintype):
+        if self.pin_store is None:
+            raise RuntimeError('Component was not created with a pin store')
+        return self.pin_store.read_array(pintype)
+
+    # sets all out and IO pins of one HAL type from a sequence in the
+    # order of read_array, input pins are skipped
+    def write_array(self, pintype, values):
+        pins = self.pins_of_type(pintype)
+        if len(values) != len(pins):
+            raise ValueError('Expected %i values, got %i' % (len(pins), len(values)))
+        if hasattr(values, 'tolist'):
+            values = values.tolist()  # convert NumPy scalars
+        with self.batch():
+            for pin, value in zip(pins, values):
+                if pin.direction != HAL_IN:
+                    pin.set(value)
+
+    # builds the bind message once, later binds only copy the pin values
+    def bind_message(self):
+        if self.bind_cache is None:
+            tx = Container()
+            tx.type = MT_HALRCOMP_BIND
+            c = tx.comp.add()
             c.name = self.name
-            c.no_create = self.no_create  # for now we create the component
-            for name, pin in self.pinsbyname.iteritems():
+            pins = []
+            for fullname, pin in self.pinsbyfullname.items():
                 p = c.pin.add()
-                p.name = '%s.%s' % (self.name, name)
+                p.name = fullname
                 p.type = pin.pintype
                 p.dir = pin.direction
-                if p.type == HAL_FLOAT:
-                    p.halfloat = float(pin.value)
-                elif p.type == HAL_BIT:
-                    p.halbit = bool(pin.value)
-                elif p.type == HAL_S32:
-                    p.hals32 = int(pin.value)
-                elif p.type == HAL_U32:
-                    p.halu32 = int(pin.value)
+                pins.append((pin, p, PIN_VALUE_FIELDS[pin.pintype], PIN_VALUE_TYPES[pin.pintype]))
+            self.bind_cache = (tx, c, pins)
+        return self.bind_cache
+
+    def bind(self):
+        with self.tx_lock:
+            tx, c, pins = self.bind_message()
+            c.no_create = self.no_create  # for now we create the component
+            for pin, p, field, value_type in pins:
+                setattr(p, field, value_type(pin.value))
             if self.debug:
                 print('[%s] bind' % self.name)
-            self.send_cmd(MT_HALRCOMP_BIND)
+                print(str(tx))
+            self.socket_call(self.send_bind, tx.SerializeToString())
+
+    def send_bind(self, data):
+        if self.session is not None:
+            self.session.bind_sent(self)  # replies are matched in send order
+        self.halrcmd_socket.send(data, zmq.NOBLOCK)
 
     def subscribe(self):
         self.halrcomp_state = 'Trying'
-        self.halrcomp_socket.setsockopt(zmq.SUBSCRIBE, self.name)
+        self.socket_call(self.halrcomp_socket.setsockopt, zmq.SUBSCRIBE, self.name)
 
     def unsubscribe(self):
         self.halrcomp_state = 'Down'
-        self.halrcomp_socket.setsockopt(zmq.UNSUBSCRIBE, self.name)
+        self.socket_call(self.halrcomp_socket.setsockopt, zmq.UNSUBSCRIBE, self.name)
 
     def __getitem__(self, k):
         return self.pinsbyname[k].get()
@@ -471,5 +1125,266 @@ class RemoteComponent():
         self.pinsbyname[k].set(v)
 
 
+class RemoteSession():
+    """Shares one halrcmd and one halrcomp socket, one socket worker and
+    one halrcmd heartbeat between the remote components of a haltalk."""
+    def __init__(self, halrcmd_uri='', halrcomp_uri='', debug=False):
+        self.threads = []
+        self.shutdown = threading.Event()
+        self.tx_lock = threading.Lock()  # shared with all components
+        self.lock = threading.Lock()
+        self.debug = debug
+
+        self.components = {}  # by name, equals the halrcomp topic
+        self.active = []  # started components
+        self.pending_binds = []  # components waiting for a bind reply
+
+        self.halrcmd_uri = halrcmd_uri
+        self.halrcomp_uri = halrcomp_uri
+        self.heartbeat_period = 3000
+        self.ping_outstanding = False
+        self.halrcmd_up = False
+        self.scheduler = TimerScheduler()  # heartbeat deadlines of all components
+        self.halrcmd_timer = HeartbeatTimer(self.scheduler, self.halrcmd_timer_tick)
+
+        # more efficient to reuse a protobuf message
+        self.tx = Container()
+        self.rx = Container()
+
+        # ZeroMQ
+        client_id = '%s-%s' % (platform.node(), uuid.uuid4())  # must be unique
+        context = zmq.Context()
+        context.linger = 0
+        self.context = context
+        self.halrcmd_socket = self.context.socket(zmq.DEALER)
+        self.halrcmd_socket.setsockopt(zmq.LINGER, 0)
+        self.halrcmd_socket.setsockopt(zmq.IDENTITY, client_id)
+        self.halrcomp_socket = self.context.socket(zmq.SUB)
+        self.sockets_connected = False
+        self.socket_calls = collections.deque()  # (func, args) of other threads, run by the worker
+        self.wakeup_lock = threading.Lock()
+        # wakes the socket worker for queued socket calls and deferred pins
+        wakeup_uri = 'inproc://session-wakeup-%s' % uuid.uuid4()
+        self.wakeup_receiver = self.context.socket(zmq.PAIR)
+        self.wakeup_receiver.bind(wakeup_uri)
+        self.wakeup_sender = self.context.socket(zmq.PAIR)
+        self.wakeup_sender.connect(wakeup_uri)
+
+    def add(self, component):
+        with self.lock:
+            if component.name in self.components:
+                raise ValueError('Component %s already exists in session' % component.name)
+            self.components[component.name] = component
+        component.session = self
+        component.context = self.context
+        component.tx_lock = self.tx_lock  # components share the DEALER socket
+        component.halrcmd_socket = self.halrcmd_socket
+        component.halrcomp_socket = self.halrcomp_socket
+
+    # create a new remote component using the sockets of the session
+    def component(self, name, compact=False):
+        return RemoteComponent(name, debug=self.debug, compact=compact, session=self)
+
+    def start_component(self, component):
+        with self.lock:
+            if component not in self.active:
+                self.active.append(component)
+            start = len(self.threads) == 0
+            bind = not start and self.halrcmd_up
+            if start:
+                self.shutdown.clear()  # in case we already used the session
+                self.threads.append(threading.Thread(target=self.socket_worker))
+
+        if start:
+            if not self.halrcmd_uri:
+                self.halrcmd_uri = component.halrcmd_uri
+            if not self.halrcomp_uri:
+                self.halrcomp_uri = component.halrcomp_uri
+            self.connect_sockets()
+            for thread in self.threads:
+                thread.start()
+            self.start_halrcmd_heartbeat()
+            with self.tx_lock:
+                self.send_cmd(MT_PING)
+        elif bind:  # halrcmd is already up
+            component.update_state('Connecting')
+            component.bind()
+
+    def stop_component(self, component):
+        with self.lock:
+            if component in self.active:
+                self.active.remove(component)
+            if len(self.active) > 0 or len(self.threads) == 0:
+                return
+            threads = self.threads
+            self.threads = []
+            self.halrcmd_up = False
+            self.pending_binds = []
+
+        # last component stopped
+        self.shutdown.set()
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        run_socket_calls(self.socket_calls, 'session')  # the worker is gone
+        self.stop_halrcmd_heartbeat()
+        self.disconnect_sockets()
+
+    def bind_sent(self, component):
+        with self.lock:
+            self.pending_binds.append(component)
+
+    def socket_worker(self):
+        poll = zmq.Poller()
+        poll.register(self.halrcmd_socket, zmq.POLLIN)
+        poll.register(self.halrcomp_socket, zmq.POLLIN)
+        poll.register(self.wakeup_receiver, zmq.POLLIN)
+
+        while not self.shutdown.is_set():
+            s = dict(poll.poll(self.poll_timeout()))
+            if self.halrcmd_socket in s:
+                self.process_halrcmd()
+            if self.halrcomp_socket in s:
+                self.process_halrcomp()
+            if self.wakeup_receiver in s:
+                drain_wakeups(self.wakeup_receiver)
+            if self.socket_calls:
+                run_socket_calls(self.socket_calls, 'session')
+            for component in self.active_components():
+                if component.rate_limited_pins:
+                    component.flush_rate_limited_pins()
+            self.scheduler.run()
+
+    def wake_worker(self):
+        with self.lock:
+            threads = list(self.threads)
+        if threads and threading.current_thread() not in threads:
+            with self.wakeup_lock:
+                send_wakeup(self.wakeup_sender)
+
+    # ZeroMQ sockets must only be used by the socket worker, other threads
+    # of the session and its components queue func(*args)
+    def socket_call(self, func, *args):
+        with self.lock:
+            threads = list(self.threads)
+        if threads and threading.current_thread() not in threads:
+            self.socket_calls.append((func, args))
+            self.wake_worker()
+        else:
+            func(*args)
+
+    def active_components(self):
+        with self.lock:
+            return list(self.active)
+
+    def poll_timeout(self):
+        timeout = self.scheduler.timeout()
+        for component in self.active_components():
+            timeout = min(timeout, component.poll_timeout())
+        return timeout
+
+    def process_halrcmd(self):
+        msg = self.halrcmd_socket.recv()
+        self.rx.ParseFromString(msg)
+        if self.debug:
+            print('[session] received message on halrcmd:')
+            print(self.rx)
+
+        if self.rx.type == MT_PING_ACKNOWLEDGE:
+            self.ping_outstanding = False
+            with self.lock:
+                self.halrcmd_up = True
+                components = [c for c in self.active if c.halrcmd_state == 'Trying']
+            for component in components:
+                component.update_state('Connecting')
+                component.bind()
+
+        elif self.rx.type == MT_HALRCOMP_BIND_CONFIRM \
+        or self.rx.type == MT_HALRCOMP_BIND_REJECT:
+            with self.lock:
+                component = None
+                if len(self.pending_binds) > 0:
+                    component = self.pending_binds.pop(0)  # haltalk replies in order
+            if component is None:
+                print('[session] Warning: received unexpected bind reply')
+                return
+            component.halrcmd_message(self.rx)
+
+        elif self.rx.type == MT_HALRCOMP_SET_REJECT:
+            components = self.active_components()
+            handles = set(rpin.handle for rpin in self.rx.pin)
+            if len(handles) > 0:
+                components = [c for c in components
+                              if not handles.isdisjoint(c.pinsbyhandle)]
+            for component in components:  # all components if no pin matches
+                component.halrcmd_message(self.rx)
+
+        else:
+            print('[session] Warning: halrcmd receiced unsupported message')
+
+    def process_halrcomp(self):
+        (topic, msg) = self.halrcomp_socket.recv_multipart(copy=False)
+        topic = topic.bytes
+        component = self.components.get(topic)
+        if component is None:  # ignore uninteresting messages before parsing
+            return
+        self.rx.ParseFromString(msg.buffer)
+        component.halrcomp_message(topic, self.rx)
+
+    def connect_sockets(self):
+        self.sockets_connected = True
+        self.halrcmd_socket.connect(self.halrcmd_uri)
+        self.halrcomp_socket.connect(self.halrcomp_uri)
+
+        return True
+
+    def disconnect_sockets(self):
+        if self.sockets_connected:
+            self.halrcmd_socket.disconnect(self.halrcmd_uri)
+            self.halrcomp_socket.disconnect(self.halrcomp_uri)
+            self.sockets_connected = False
+
+    def send_cmd(self, msg_type):
+        if msg_type == MT_PING:  # constant message, encoded once
+            if self.debug:
+                print('[session] sending message: %s' % msg_type)
+            self.socket_call(self.halrcmd_socket.send, ping_message, zmq.NOBLOCK)
+            return
+        self.tx.type = msg_type
+        if self.debug:
+            print('[session] sending message: %s' % msg_type)
+            print(str(self.tx))
+        self.socket_call(self.halrcmd_socket.send, self.tx.SerializeToString(), zmq.NOBLOCK)
+        self.tx.Clear()
+
+    def halrcmd_timer_tick(self):
+        if self.shutdown.is_set():
+            return
+
+        if self.ping_outstanding:
+            with self.lock:
+                self.halrcmd_up = False
+                self.pending_binds = []  # a late reply must not match the next bind
+                components = list(self.active)
+            for component in components:
+                component.halrcmd_state = 'Trying'
+                component.update_state('Timeout')
+
+        with self.tx_lock:
+            self.send_cmd(MT_PING)
+        self.ping_outstanding = True
+
+        self.halrcmd_timer.start(self.heartbeat_period)  # rearm timer
+
+    def start_halrcmd_heartbeat(self):
+        self.ping_outstanding = False
+
+        if self.heartbeat_period > 0:
+            self.halrcmd_timer.start(self.heartbeat_period)
+
+    def stop_halrcmd_heartbeat(self):
+        self.halrcmd_timer.stop()
+
+
 def component(name):
     return RemoteComponent(name)